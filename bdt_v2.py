@@ -5,6 +5,7 @@ import urllib3
 import time
 import argparse
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import SQLAlchemyError
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -59,6 +60,15 @@ vts_pass = config_vts["password"]
 vts_tokenUrl = config_vts["tokenUrl"]
 vts_detokenUrl = config_vts["detokenUrl"]
 
+# One pooled session for the whole run so worker threads reuse keep-alive connections
+vts_session = requests.Session()
+vts_session.auth = HTTPBasicAuth(vts_user, vts_pass)
+vts_session.verify = False
+vts_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config_vts.get("maxConnections", (os.cpu_count() or 1) * 5))
+vts_session.mount("http://", vts_adapter)
+vts_session.mount("https://", vts_adapter)
+vts_timeout = (config_vts.get("connectTimeout", 5.0), config_vts.get("readTimeout", 10.0))
+
 # Set up DB connections
 source_engine = create_engine(source_connectionurl)
 destination_engine = create_engine(destination_connectionurl)
@@ -99,12 +109,11 @@ def process_row(row_idx, row_dict):
     try:
         # Process TOKENIZE
         if tokenize_payload:
-            response = requests.post(
+            response = vts_session.post(
                 vts_tokenUrl,
                 json=tokenize_payload,
                 headers=headers,
-                auth=HTTPBasicAuth(vts_user, vts_pass),
-                verify=False
+                timeout=vts_timeout
             )
             response.raise_for_status()
             tokens = response.json()
@@ -113,12 +122,11 @@ def process_row(row_idx, row_dict):
 
         # Process DETOKENIZE
         if detokenize_payload:
-            response = requests.post(
+            response = vts_session.post(
                 vts_detokenUrl,
                 json=detokenize_payload,
                 headers=headers,
-                auth=HTTPBasicAuth(vts_user, vts_pass),
-                verify=False
+                timeout=vts_timeout
             )
             response.raise_for_status()
             detokens = response.json()
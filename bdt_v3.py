@@ -5,6 +5,7 @@ import urllib3
 import time
 import argparse
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import SQLAlchemyError
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -45,12 +46,25 @@ table_src = policy['tables'][0]['sourceTable']
 table_dest = policy['tables'][0]['destinationTable']
 columns_config = policy['tables'][0]['columns']
 
+# Column plan, built once: (name, tokenGroup, tokenTemplate) per action
+tokenize_plan = [(c['name'], c['config'][0]['tokenGroup'], c['config'][0]['tokenTemplate']) for c in columns_config if c['action'] == 'TOKENIZE']
+detokenize_plan = [(c['name'], c['config'][0]['tokenGroup'], c['config'][0]['tokenTemplate']) for c in columns_config if c['action'] == 'DETOKENIZE']
+
 # === VTS Configuration ===
 vts = config['vts']
 batch_size = config['batchSize']
 vts_auth = HTTPBasicAuth(vts['userName'], vts['password'])
 headers = {"Content-Type": "application/json"}
 
+# One pooled session for the whole run so worker threads reuse keep-alive connections
+session = requests.Session()
+session.auth = vts_auth
+session.verify = False
+session.headers.update(headers)
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=vts.get('maxConnections', get_optimal_workers()))
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
 # === DB Engines ===
 engine_src = create_engine(source_url)
 engine_dest = create_engine(dest_url)
@@ -59,30 +73,23 @@ engine_dest = create_engine(dest_url)
 def process_row(idx, row):
     try:
         log("INFO", "Start processing", idx)
-        original = row.copy()
-        tok_payload, detok_payload, actions = [], [], []
-
-        for col in columns_config:
-            name, action = col['name'], col['action']
-            cfg = col['config'][0]
-            if action == 'TOKENIZE':
-                tok_payload.append({"tokengroup": cfg['tokenGroup'], "data": row[name], "tokentemplate": cfg['tokenTemplate']})
-            elif action == 'DETOKENIZE':
-                detok_payload.append({"tokengroup": cfg['tokenGroup'], "token": row[name], "tokentemplate": cfg['tokenTemplate']})
-
-        if tok_payload:
-            res = requests.post(vts['tokenUrl'], json=tok_payload, headers=headers, auth=vts_auth, verify=False)
+        actions = []
+
+        if tokenize_plan:
+            tok_payload = [{"tokengroup": group, "data": row[name], "tokentemplate": template} for name, group, template in tokenize_plan]
+            res = session.post(vts['tokenUrl'], json=tok_payload, timeout=(vts.get('connectTimeout', 5.0), vts.get('readTimeout', 10.0)))
             res.raise_for_status()
-            for col, val in zip([c for c in columns_config if c['action'] == 'TOKENIZE'], res.json()):
-                row[col['name']] = val['token']
-                actions.append(f"[TOKENIZE] {col['name']} → {val['token']}")
+            for (name, _, _), val in zip(tokenize_plan, res.json()):
+                row[name] = val['token']
+                actions.append(f"[TOKENIZE] {name} → {val['token']}")
 
-        if detok_payload:
-            res = requests.post(vts['detokenUrl'], json=detok_payload, headers=headers, auth=vts_auth, verify=False)
+        if detokenize_plan:
+            detok_payload = [{"tokengroup": group, "token": row[name], "tokentemplate": template} for name, group, template in detokenize_plan]
+            res = session.post(vts['detokenUrl'], json=detok_payload, timeout=(vts.get('connectTimeout', 5.0), vts.get('readTimeout', 10.0)))
             res.raise_for_status()
-            for col, val in zip([c for c in columns_config if c['action'] == 'DETOKENIZE'], res.json()):
-                row[col['name']] = val['data']
-                actions.append(f"[DETOKENIZE] {col['name']} → {val['data']}")
+            for (name, _, _), val in zip(detokenize_plan, res.json()):
+                row[name] = val['data']
+                actions.append(f"[DETOKENIZE] {name} → {val['data']}")
 
         log("SUCCESS", "Processed successfully", idx)
         for a in actions:
@@ -6,11 +6,29 @@ import time
 import argparse
 import httpx
 import asyncio
-from requests.auth import HTTPBasicAuth
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import SQLAlchemyError
+import io
+import re
+import hashlib
+import glob
+import hmac
+import random
+import sqlite3
+import queue
+import multiprocessing
+import sys
+import atexit
+import logging
+import logging.handlers
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from sqlalchemy import create_engine, text, select, insert, table, column, func, and_, or_, not_, tuple_, inspect, Table, MetaData, Column, String, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError, NoSuchTableError
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from datetime import datetime, date, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -18,10 +36,20 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 def get_timestamp():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def log(level, message, row_id=None):
-    prefix = f"[{level}] {get_timestamp()}"
-    suffix = f" Row {row_id}" if row_id is not None else ""
-    print(f"{prefix}{suffix} - {message}")
+shard_label = ""
+
+def log(level, message, row_id=None, summary=False):
+    # Records are queued and written by a background thread (see Logging below). Summary records
+    # go through a logger that --quiet leaves enabled.
+    target = summary_logger if summary else logger
+    level_no = LOG_LEVELS[level]
+    if target.isEnabledFor(level_no):
+        target.log(level_no, message, extra={'row_id': row_id, 'shard': shard_label})
+
+def log_row(level, message, row_id):
+    # Per-row events are sampled 1-in-rowLogSample; failures are always recorded
+    if level == "ERROR" or (row_log_sample and row_id % row_log_sample == 0):
+        log(level, message, row_id)
 
 def get_optimal_workers():
     return (os.cpu_count() or 1) * 4
@@ -30,6 +58,12 @@ def get_optimal_workers():
 parser = argparse.ArgumentParser(description="BDT Transformation Script")
 parser.add_argument("-p", "--policy", required=True, help="Path to the transformation policy JSON file")
 parser.add_argument("-c", "--config", default="bdt.config", help="Path to the config JSON file")
+parser.add_argument("--incremental", action="store_true", help="Only process rows after the previous successful run's watermark")
+parser.add_argument("--restart", action="store_true", help="Discard saved checkpoints instead of resuming an unfinished run")
+parser.add_argument("-q", "--quiet", action="store_true", help="Only log errors and the run summary")
+parser.add_argument("--replay", action="store_true", help="Reprocess only the rows listed in the bad record file")
+parser.add_argument("--plan", action="store_true", help="Sample the source, VTS and destination, print a projected runtime and recommended settings, and exit without writing")
+parser.add_argument("--plan-sample", type=int, default=1000, help="Rows tokenized and test-written per table by --plan")
 args = parser.parse_args()
 
 # === Load Policy and Config ===
@@ -38,95 +72,1961 @@ with open(args.policy, 'r', encoding='utf-8') as f:
 with open(args.config, 'r', encoding='utf-8') as f:
     config = json.load(f)
 
+# === Logging ===
+LOG_LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'SUCCESS': 25, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+logging.addLevelName(25, 'SUCCESS')
+row_log_sample = config.get('rowLogSample', 1000)
+
+class LineFormatter(logging.Formatter):
+    def format(self, record):
+        ts = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S")
+        suffix = f" Row {record.row_id}" if record.row_id is not None else ""
+        return f"[{record.levelname}] {ts}{record.shard}{suffix} - {record.getMessage()}"
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"), "level": record.levelname, "msg": record.getMessage()}
+        if record.shard:
+            entry["shard"] = record.shard.strip()
+        if record.row_id is not None:
+            entry["row"] = record.row_id
+        return json.dumps(entry)
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if config.get('logFormat') == 'json' else LineFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    level = logging.ERROR if args.quiet else LOG_LEVELS[config.get('logLevel', 'INFO')]
+    for name, lvl in (('bdt', level), ('bdt.summary', logging.INFO)):
+        lg = logging.getLogger(name)
+        lg.setLevel(lvl)
+        lg.propagate = False
+        lg.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logging.getLogger('bdt'), logging.getLogger('bdt.summary')
+
+logger, summary_logger = setup_logging()
+
+# === Metrics ===
+# In-process counters, gauges and bucketed histograms keyed by (name, labels). Shard workers send
+# snapshots to the coordinator, which merges them. Written at the end of the run as a JSON report
+# (reportFile) and optionally as a Prometheus textfile for node_exporter (prometheusFile).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    'bdt_rows_read_total': ('counter', 'Source rows read'),
+    'bdt_rows_written_total': ('counter', 'Rows committed to the destination'),
+    'bdt_rows_failed_total': ('counter', 'Rows dropped because a VTS value failed'),
+    'bdt_values_skipped_total': ('counter', 'Values kept from VTS by the pre-filter, by reason'),
+    'bdt_bad_records_total': ('counter', 'Failed rows appended to the bad record file'),
+    'bdt_vts_requests_total': ('counter', 'VTS HTTP responses by status'),
+    'bdt_vts_retries_total': ('counter', 'VTS request retries'),
+    'bdt_vts_node_requests_total': ('counter', 'VTS requests per node by outcome'),
+    'bdt_vts_node_ejections_total': ('counter', 'Times a VTS node was taken out of rotation'),
+    'bdt_vts_splits_total': ('counter', 'Failed VTS bulk requests split in two and retried'),
+    'bdt_vts_breaker_open_total': ('counter', 'Times the VTS circuit breaker opened'),
+    'bdt_vts_in_flight_max': ('gauge', 'Highest number of VTS requests in flight'),
+    'bdt_vts_concurrency_limit': ('gauge', 'Adaptive VTS concurrency limit at the end of the run'),
+    'bdt_fetch_seconds': ('histogram', 'Source query time per chunk'),
+    'bdt_vts_request_seconds': ('histogram', 'VTS request latency'),
+    'bdt_vts_node_seconds': ('histogram', 'VTS request latency per node'),
+    'bdt_vts_decode_seconds': ('histogram', 'VTS response JSON decode time'),
+    'bdt_fpe_seconds': ('histogram', 'Local FPE time per bulk'),
+    'bdt_tokenize_chunk_seconds': ('histogram', 'Time to tokenize one chunk'),
+    'bdt_insert_seconds': ('histogram', 'Destination write and commit time per commit chunk'),
+    'bdt_run_duration_seconds': ('gauge', 'Wall-clock duration of the run'),
+    'bdt_last_run_timestamp_seconds': ('gauge', 'Unix time the run finished'),
+}
+metrics = {'counters': {}, 'gauges': {}, 'histograms': {}, 'timeline': {}}
+metrics_lock = threading.Lock()
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metrics['counters'][key] = metrics['counters'].get(key, 0) + value
+        if name == 'bdt_rows_written_total':
+            second = int(time.time())
+            metrics['timeline'][second] = metrics['timeline'].get(second, 0) + value
+
+def set_gauge(name, value, high_water=False, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        if not high_water or value > metrics['gauges'].get(key, value - 1):
+            metrics['gauges'][key] = value
+
+def observe(name, value, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        hist = metrics['histograms'].get(key)
+        if hist is None:
+            hist = metrics['histograms'][key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'count': 0, 'sum': 0.0}
+        i = 0
+        while i < len(LATENCY_BUCKETS) and value > LATENCY_BUCKETS[i]:
+            i += 1
+        hist['buckets'][i] += 1
+        hist['count'] += 1
+        hist['sum'] += value
+
+def shard_labels():
+    # Gauges are per process, so shard workers label theirs instead of overwriting each other on merge
+    return {'shard': shard_index} if shard_count > 1 else {}
+
+def metrics_snapshot():
+    with metrics_lock:
+        return {
+            'counters': dict(metrics['counters']),
+            'gauges': dict(metrics['gauges']),
+            'histograms': {k: {'buckets': list(h['buckets']), 'count': h['count'], 'sum': h['sum']} for k, h in metrics['histograms'].items()},
+            'timeline': dict(metrics['timeline']),
+        }
+
+def merge_metrics(snapshots):
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}, 'timeline': {}}
+    for snap in snapshots:
+        for kind in ('counters', 'timeline'):
+            for k, v in snap[kind].items():
+                merged[kind][k] = merged[kind].get(k, 0) + v
+        merged['gauges'].update(snap['gauges'])
+        for k, h in snap['histograms'].items():
+            m = merged['histograms'].setdefault(k, {'buckets': [0] * len(h['buckets']), 'count': 0, 'sum': 0.0})
+            m['buckets'] = [a + b for a, b in zip(m['buckets'], h['buckets'])]
+            m['count'] += h['count']
+            m['sum'] += h['sum']
+    with metrics_lock:
+        for kind in merged:
+            metrics[kind].update(merged[kind])
+
+def quantile(hist, q):
+    # Linear interpolation inside the bucket holding the q-th observation
+    if not hist['count']:
+        return None
+    rank, seen, lower = q * hist['count'], 0, 0.0
+    for i, n in enumerate(hist['buckets']):
+        upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+        if n and seen + n >= rank:
+            return lower + (upper - lower) * (rank - seen) / n
+        seen += n
+        lower = upper
+    return lower
+
+def write_reports(started, all_stats):
+    finished = time.time()
+    set_gauge('bdt_run_duration_seconds', round(finished - started, 3))
+    set_gauge('bdt_last_run_timestamp_seconds', round(finished))
+    snap = metrics_snapshot()
+
+    def labels_dict(key):
+        return dict(key[1])
+
+    if config.get('reportFile'):
+        report = {
+            'policy': policy_id,
+            'started': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+            'finished': datetime.fromtimestamp(finished).isoformat(timespec='seconds'),
+            'durationSeconds': round(finished - started, 3),
+            'tables': [{'sourceTable': t['sourceTable'], 'destinationTable': t['destinationTable'], **st} for t, st in zip(tables, all_stats)],
+            'tokenCache': dict(cache_stats),
+            'counters': [{'name': k[0], 'labels': labels_dict(k), 'value': v} for k, v in sorted(snap['counters'].items())],
+            'gauges': [{'name': k[0], 'labels': labels_dict(k), 'value': v} for k, v in sorted(snap['gauges'].items())],
+            'histograms': [{
+                'name': k[0], 'labels': labels_dict(k), 'count': h['count'], 'sum': round(h['sum'], 6),
+                'p50': quantile(h, 0.5), 'p95': quantile(h, 0.95), 'p99': quantile(h, 0.99),
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], h['buckets'])),
+            } for k, h in sorted(snap['histograms'].items())],
+            'rowsPerSecond': [{'second': round(sec - started), 'rows': n} for sec, n in sorted(snap['timeline'].items())],
+        }
+        with open(config['reportFile'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, default=str)
+        log("INFO", f"Run report written to {config['reportFile']}", summary=True)
+
+    if config.get('prometheusFile'):
+        def fmt(labels):
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}' if labels else ''
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            series = {'counter': snap['counters'], 'gauge': snap['gauges'], 'histogram': snap['histograms']}[kind]
+            keys = sorted(k for k in series if k[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                if kind != 'histogram':
+                    lines.append(f"{name}{fmt(key[1])} {series[key]}")
+                    continue
+                h, cumulative = series[key], 0
+                for le, n in zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], h['buckets']):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{fmt(key[1] + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{fmt(key[1])} {h['sum']}")
+                lines.append(f"{name}_count{fmt(key[1])} {h['count']}")
+        # Write then rename so node_exporter never reads a half-written file
+        tmp = config['prometheusFile'] + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, config['prometheusFile'])
+
+    for key, h in sorted(snap['histograms'].items()):
+        if key[0] == 'bdt_vts_request_seconds' and h['count']:
+            labels = labels_dict(key)
+            log("INFO", f"VTS {labels.get('action')}/{labels.get('template')}: {h['count']} requests, p50 {quantile(h, 0.5) * 1000:.0f}ms, p99 {quantile(h, 0.99) * 1000:.0f}ms", summary=True)
+    for key, h in sorted(snap['histograms'].items()):
+        if key[0] == 'bdt_vts_node_seconds' and h['count']:
+            node = labels_dict(key)['node']
+            errors = sum(v for k, v in snap['counters'].items() if k[0] == 'bdt_vts_node_requests_total' and dict(k[1]) == {'node': node, 'outcome': 'error'})
+            ejections = sum(v for k, v in snap['counters'].items() if k[0] == 'bdt_vts_node_ejections_total' and dict(k[1]).get('node') == node)
+            log("INFO", f"VTS node {node}: {h['count']} requests, {errors} errors, p50 {quantile(h, 0.5) * 1000:.0f}ms, p99 {quantile(h, 0.99) * 1000:.0f}ms, ejected {ejections}x", summary=True)
+
 # === Extract Policy Info ===
 source_url = policy['source']['connectionurl']
 dest_url = policy['destination']['connectionurl']
-schema_src = policy['tables'][0]['sourceSchema']
-schema_dest = policy['tables'][0]['destinationSchema']
-table_src = policy['tables'][0]['sourceTable']
-table_dest = policy['tables'][0]['destinationTable']
-columns_config = policy['tables'][0]['columns']
+policy_id = policy.get('id') or os.path.basename(args.policy)
+tables = policy['tables']
+
+# inPlaceUpdate writes the transformed columns back into each source table; the destination is ignored
+in_place = policy.get('inPlaceUpdate', False)
+if in_place:
+    dest_url = source_url
+    for tbl in tables:
+        tbl['destinationSchema'], tbl['destinationTable'] = tbl['sourceSchema'], tbl['sourceTable']
 
 # === VTS Configuration ===
 vts = config['vts']
 batch_size = config['batchSize']
-vts_auth = HTTPBasicAuth(vts['userName'], vts['password'])
+bulk_size = vts.get('bulkSize', 1000)
+queue_size = config.get('queueSize', 4)
+tokenizer_workers = config.get('tokenizerWorkers', 4)
+commit_size = config.get('commitSize', batch_size)
+table_concurrency = config.get('tableConcurrency', 2)
+shard_count = max(1, config.get('threadCount', 1))
+vts_node_count = max(1, len(vts.get('nodes') or []))
+# maxConnections and initialConcurrency are per VTS node, so capacity grows with the cluster
+vts_budget = vts.get('maxConnections', 100) * vts_node_count
+vts_floor = vts.get('minConcurrency', 1)
+vts_initial = vts.get('initialConcurrency', 16) * vts_node_count
+latency_tolerance = vts.get('latencyTolerance', 2.0)
+state_path = config.get('stateFile', 'bdt_state.db')
+write_mode = config.get('writeMode', 'insert')
+bad_record_path = config.get('badRecordFile', f"bdt_bad_records_{policy_id}.jsonl") if policy.get('createBadRecordFile') else None
+vts_auth = httpx.BasicAuth(vts['userName'], vts['password'])
 headers = {"Content-Type": "application/json"}
 
+# === Token Cache Configuration ===
+cache_cfg = config.get('tokenCache', {})
+cache_max_entries = cache_cfg.get('maxEntries', 100000)
+cache_templates = set(cache_cfg.get('deterministicTemplates', []))
+# Keys in the cache file are HMACs under a secret (tokenCache.key, else crypto.pin), so the file
+# cannot be turned into a plaintext -> token dictionary by hashing guessed values
+cache_secret = cache_cfg.get('key') or config.get('crypto', {}).get('pin')
+if cache_cfg.get('path') and cache_max_entries > 0 and not cache_secret:
+    raise RuntimeError("tokenCache.path needs tokenCache.key or crypto.pin")
+cache_key = hashlib.pbkdf2_hmac('sha256', cache_secret.encode('utf-8'), b'bdt-cache', 200000) if cache_cfg.get('path') and cache_secret else None
+
+# === Character Sets and Local FPE Configuration ===
+crypto_cfg = config.get('crypto', {})
+fpe_templates = crypto_cfg.get('templates', {})
+template_charsets = config.get('templateCharacterSets', {})
+character_sets = {}
+for entry in config.get('characterSets', []):
+    for name, ranges in entry.items():
+        chars = set()
+        for r in ranges:
+            lo, _, hi = r.partition('-')
+            chars.update(chr(c) for c in range(int(lo, 16), int(hi or lo, 16) + 1))
+        character_sets[name] = ''.join(sorted(chars))
+for template, charset in fpe_templates.items():
+    if charset not in character_sets:
+        raise RuntimeError(f"crypto.templates maps {template} to unknown character set {charset}")
+for template, charset in template_charsets.items():
+    if charset not in character_sets:
+        raise RuntimeError(f"templateCharacterSets maps {template} to unknown character set {charset}")
+# One compiled class per template matching any character outside its set
+template_validators = {t: re.compile('[^' + ''.join(re.escape(ch) for ch in character_sets[name]) + ']') for t, name in template_charsets.items()}
+if fpe_templates and not crypto_cfg.get('pin'):
+    raise RuntimeError("crypto.templates needs crypto.pin")
+fpe_key = hashlib.pbkdf2_hmac('sha256', crypto_cfg['pin'].encode('utf-8'), b'bdt-fpe', 200000) if fpe_templates else None
+
 # === DB Engines ===
-engine_src = create_engine(source_url)
-engine_dest = create_engine(dest_url)
+# hide_parameters keeps bound row values (plaintext and tokens) out of SQLAlchemy error messages
+engine_src = create_engine(source_url, hide_parameters=True)
+src_backend = make_url(source_url).get_backend_name()
+dest_backend = make_url(dest_url).get_backend_name()
+dest_driver = make_url(dest_url).get_driver_name()
+if dest_backend == 'mssql' and dest_driver == 'pyodbc':
+    engine_dest = create_engine(dest_url, fast_executemany=True, hide_parameters=True)
+else:
+    engine_dest = create_engine(dest_url, hide_parameters=True)
 
-# === Retry post ===
-async def post_with_retry(client, url, payload, headers, retries=3):
-    for attempt in range(retries):
-        try:
-            return await client.post(url, json=payload, headers=headers)
-        except httpx.ConnectTimeout as e:
-            if attempt < retries - 1:
-                await asyncio.sleep(5 ** attempt)
-            else:
-                # You can also log the row number here if passed in
-                raise RuntimeError(f"ConnectTimeout after {retries} retries") from e
+# === Source Reader ===
+def get_primary_key(tbl):
+    if 'primaryKey' not in tbl:
+        tbl['primaryKey'] = inspect(engine_src).get_pk_constraint(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)['constrained_columns']
+    return tbl['primaryKey']
 
-# === Tokenize / Detokenize Logic ===
-async def process_row(idx, row):
+def nullable_columns(tbl, names):
+    # Keyset pagination cannot step past a NULL key, and dialects disagree on where NULLs sort.
+    # Primary key columns count as NOT NULL (SQLite reports non-integer ones as nullable).
+    pk = get_primary_key(tbl)
+    info = {c['name']: c for c in inspect(engine_src).get_columns(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)}
+    return [n for n in names if n not in pk and info.get(n, {}).get('nullable', True)]
+
+def get_key_columns(tbl):
+    if 'keyColumnsChecked' in tbl:
+        return tbl['keyColumns']
+    pk = get_primary_key(tbl)
+    if tbl.get('keyColumns'):
+        nullable = nullable_columns(tbl, tbl['keyColumns'])
+        if nullable:
+            raise RuntimeError(f"keyColumns of {tbl['sourceTable']} must be NOT NULL, but {', '.join(nullable)} is nullable")
+    else:
+        keys = ['created_at'] + [c for c in pk if c != 'created_at']
+        if not nullable_columns(tbl, ['created_at']):
+            if not pk:
+                log("WARNING", f"No keyColumns in policy and no primary key on {tbl['sourceTable']}; rows sharing a created_at value may be skipped")
+        elif pk:
+            log("WARNING", f"{tbl['sourceTable']}.created_at is missing or nullable; paging by the primary key ({', '.join(pk)}) instead")
+            keys = list(pk)
+        else:
+            raise RuntimeError(f"{tbl['sourceTable']} has no primary key and created_at is missing or nullable; set NOT NULL keyColumns in the policy")
+        tbl['keyColumns'] = keys
+    tbl['keyColumnsChecked'] = True
+    return tbl['keyColumns']
+
+def transformed_columns(tbl):
+    return [col['name'] for col in tbl['columns'] if col['action'] in RESULT_KEY]
+
+def unique_key(tbl):
+    # In-place updates and upserts match rows on the primary key, or on keyColumns when the table has none
+    keys = get_primary_key(tbl) or tbl.get('keyColumns')
+    if not keys:
+        raise RuntimeError(f"{tbl['sourceTable']} has no primary key or keyColumns to match rows on")
+    return keys
+
+def destination_columns(tbl):
     try:
-        log("INFO", "Start processing", idx)
-        original = row.copy()
-        tok_payload, detok_payload, actions = [], [], []
+        return [c['name'] for c in inspect(engine_dest).get_columns(tbl['destinationTable'], schema=tbl['destinationSchema'] or None)]
+    except NoSuchTableError:
+        return None
 
-        for col in columns_config:
-            name, action = col['name'], col['action']
+def get_plan(tbl):
+    # The policy entry compiled once per table. Rows travel through the pipeline as lists in
+    # plan['columns'] order, and every step works on precomputed positions instead of names:
+    #   columns  projected source columns, the only ones selected
+    #   keys     positions of the keyset columns (checkpoints, bad records)
+    #   groups   (action, tokenGroup, tokenTemplate) -> positions sent to VTS together
+    #   write    destination columns and their positions (in place: update key and transformed columns)
+    if 'plan' in tbl:
+        return tbl['plan']
+    keys, transformed = get_key_columns(tbl), transformed_columns(tbl)
+    if in_place:
+        # Only the key and transformed columns leave the database
+        update = unique_key(tbl)
+        overlap = [c for c in transformed if c in keys or c in update]
+        if overlap:
+            raise RuntimeError(f"inPlaceUpdate cannot transform key columns of {tbl['sourceTable']}: {', '.join(overlap)}")
+        columns = list(dict.fromkeys(keys + update + transformed))
+        write = update + transformed
+    else:
+        source = [c['name'] for c in inspect(engine_src).get_columns(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)]
+        missing = [c for c in keys + transformed if c not in source]
+        if missing:
+            raise RuntimeError(f"{tbl['sourceTable']} has no column(s) {', '.join(missing)}")
+        # Source columns the destination does not have are never fetched, except keys
+        dest = destination_columns(tbl)
+        write = [c for c in source if dest is None or c in dest]
+        columns = write + [c for c in keys if c not in write]
+    index = {c: i for i, c in enumerate(columns)}
+    groups = {}
+    for col in tbl['columns']:
+        if col['action'] in RESULT_KEY:
+            if col['name'] not in index:
+                log("WARNING", f"{tbl['destinationTable']} has no column {col['name']}; it is not transformed")
+                continue
             cfg = col['config'][0]
-            if action == 'TOKENIZE':
-                tok_payload.append({"tokengroup": cfg['tokenGroup'], "data": row[name], "tokentemplate": cfg['tokenTemplate']})
-            elif action == 'DETOKENIZE':
-                detok_payload.append({"tokengroup": cfg['tokenGroup'], "token": row[name], "tokentemplate": cfg['tokenTemplate']})
-
-        timeout = httpx.Timeout(10.0, connect=5.0)  # 10s total timeout, 5s to connect
-        async with httpx.AsyncClient(verify=False, auth=vts_auth, timeout=timeout) as client:
-            if tok_payload:
-                # print(tok_payload)
-                res = await post_with_retry(client, vts['tokenUrl'], tok_payload, headers)
-                try:
-                    res.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    log("ERROR", f"Row {idx} HTTP status {e.response.status_code}: {e.response.text}")
-                    raise
-                for col, val in zip([c for c in columns_config if c['action'] == 'TOKENIZE'], res.json()):
-                    row[col['name']] = val['token']
-                    actions.append(f"[TOKENIZE] {col['name']} → {val['token']}")
-
-            if detok_payload:
-                res = await post_with_retry(client, vts['detokenUrl'], detok_payload, headers)
-                try:
-                    res.raise_for_status()
-                except httpx.HTTPStatusError as e:
-                    log("ERROR", f"Row {idx} HTTP status {e.response.status_code}: {e.response.text}")
-                    raise
-                for col, val in zip([c for c in columns_config if c['action'] == 'DETOKENIZE'], res.json()):
-                    row[col['name']] = val['data']
-                    actions.append(f"[DETOKENIZE] {col['name']} → {val['data']}")
-
-        log("SUCCESS", "Processed successfully", idx)
-        for a in actions:
-            print(f"    {a}")
-        return (idx, row)
+            groups.setdefault((col['action'], cfg['tokenGroup'], cfg['tokenTemplate']), []).append(index[col['name']])
+    write_idx = [index[c] for c in write]
+    tbl['plan'] = {
+        'columns': columns,
+        'keys': [index[k] for k in keys],
+        'groups': groups,
+        'write': write,
+        # None when rows can be written as they are
+        'write_idx': None if write_idx == list(range(len(columns))) else write_idx,
+    }
+    return tbl['plan']
+
+def project(rows, positions):
+    return rows if positions is None else [[row[i] for i in positions] for row in rows]
+
+# Source dialects that compare row values, (k1, k2) > (v1, v2), and can seek an index with it
+ROW_VALUE_BACKENDS = {'postgresql', 'mysql', 'mariadb', 'sqlite'}
+
+def keyset_after(cols, last_key):
+    # (k1, k2, ...) > (v1, v2, ...), spelled out where there is no row-value comparison (SQL Server,
+    # Oracle). The leading k1 >= v1 lets the database start an index range at the last key instead of
+    # scanning every row before it, which would make each chunk slower the further into the table it is.
+    if len(cols) == 1:
+        return cols[0] > last_key[0]
+    if src_backend in ROW_VALUE_BACKENDS:
+        after = tuple_(*cols) > tuple_(*last_key)
+    else:
+        after = or_(*[
+            and_(*[cols[j] == last_key[j] for j in range(i)], cols[i] > last_key[i])
+            for i in range(len(cols))
+        ])
+    return and_(cols[0] >= last_key[0], after)
+
+def fetch_chunks(tbl, bounds=(None, None)):
+    # bounds is an optional (lower, upper] key range, used by shard workers
+    key_names = get_key_columns(tbl)
+    key_cols = [column(k) for k in key_names]
+    src = table(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)
+    plan = get_plan(tbl)
+    projection = [column(c) for c in plan['columns']]
+    log("INFO", f"Fetching {tbl['sourceTable']} in chunks of {batch_size} rows ordered by ({', '.join(key_names)})")
+    last_key, upper = bounds
+    while True:
+        query = select(*projection).select_from(src).order_by(*key_cols).limit(batch_size)
+        if last_key is not None:
+            query = query.where(keyset_after(key_cols, last_key))
+        if upper is not None:
+            query = query.where(not_(keyset_after(key_cols, upper)))
+        # One short query per chunk, streamed through a server-side cursor
+        started = time.monotonic()
+        with engine_src.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+            chunk = [list(r) for r in result]
+        observe('bdt_fetch_seconds', time.monotonic() - started, table=tbl['sourceTable'])
+        inc('bdt_rows_read_total', len(chunk), table=tbl['sourceTable'])
+        if not chunk:
+            return
+        # Taken before the chunk is handed on, tokenizers rewrite the rows in place
+        last_key = [chunk[-1][i] for i in plan['keys']]
+        yield chunk
+        if len(chunk) < batch_size:
+            return
+
+def shard_ranges(tbl, n, total, lower=None):
+    # Split the key space after lower into n (lower, upper] ranges of roughly total / n rows each.
+    # Shards left without a range (tables smaller than n rows) get None and skip the table.
+    if n == 1:
+        return [(lower, None)]
+    key_names = get_key_columns(tbl)
+    key_cols = [column(k) for k in key_names]
+    src = table(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)
+    boundaries = []
+    with engine_src.connect() as conn:
+        keys = select(*key_cols).select_from(src)
+        if lower is not None:
+            keys = keys.where(keyset_after(key_cols, lower))
+            total = conn.execute(select(func.count()).select_from(keys.subquery())).scalar()
+        for k in range(1, n):
+            offset = k * total // n
+            if offset == 0:
+                continue
+            row = conn.execute(keys.order_by(*key_cols).offset(offset - 1).limit(1)).first()
+            if row is not None and (not boundaries or list(row) != boundaries[-1]):
+                boundaries.append(list(row))
+    edges = [lower] + boundaries + [None]
+    ranges = [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+    return ranges + [None] * (n - len(ranges))
+
+# === Run State ===
+# Checkpoints and watermarks live in a local SQLite file (stateFile). Each table run is split into
+# one (lower, upper] range per shard; the writer records the key of the last committed row of its
+# range after every commit, so a crashed run resumes from there. When every range of a table is
+# done, the highest checkpoint becomes the table's watermark for --incremental runs.
+shard_index = 0
+
+def tag_value(v):
+    # JSON-safe form of a key value that decodes back to the same Python type
+    if isinstance(v, datetime):
+        return {'datetime': v.isoformat()}
+    if isinstance(v, date):
+        return {'date': v.isoformat()}
+    if isinstance(v, Decimal):
+        return {'decimal': str(v)}
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return {'bytes': bytes(v).hex()}
+    if isinstance(v, (str, int, float, bool)) or v is None:
+        return v
+    return str(v)
+
+def untag_value(v):
+    if isinstance(v, dict):
+        (kind, value), = v.items()
+        if kind == 'datetime':
+            return datetime.fromisoformat(value)
+        if kind == 'date':
+            return date.fromisoformat(value)
+        if kind == 'decimal':
+            return Decimal(value)
+        if kind == 'bytes':
+            return bytes.fromhex(value)
+    return v
+
+def encode_key(values):
+    if values is None:
+        return None
+    return json.dumps([tag_value(v) for v in values])
+
+def decode_key(raw):
+    if raw is None:
+        return None
+    return [untag_value(v) for v in json.loads(raw)]
+
+def table_id(tbl):
+    return f"{tbl['sourceSchema']}.{tbl['sourceTable']}->{tbl['destinationSchema']}.{tbl['destinationTable']}"
+
+def state_db():
+    conn = sqlite3.connect(state_path, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (policy TEXT, source_table TEXT, range_idx INTEGER, lower TEXT, upper TEXT, checkpoint TEXT, done INTEGER, PRIMARY KEY (policy, source_table, range_idx))")
+    conn.execute("CREATE TABLE IF NOT EXISTS watermarks (policy TEXT, source_table TEXT, watermark TEXT, updated_at TEXT, PRIMARY KEY (policy, source_table))")
+    return conn
+
+def plan_ranges(tbl, size):
+    # Returns the (lower, upper] bounds each shard should read, resuming a saved run when there is one
+    if not state_path:
+        return shard_ranges(tbl, shard_count, size)
+    conn = state_db()
+    try:
+        tid = table_id(tbl)
+        saved = conn.execute("SELECT lower, upper, checkpoint, done FROM checkpoints WHERE policy = ? AND source_table = ? ORDER BY range_idx", (policy_id, tid)).fetchall()
+        if saved and args.restart:
+            conn.execute("DELETE FROM checkpoints WHERE policy = ? AND source_table = ?", (policy_id, tid))
+            saved = []
+        if saved:
+            if len(saved) != shard_count:
+                raise RuntimeError(f"Saved checkpoint for {tbl['sourceTable']} has {len(saved)} ranges but threadCount is {shard_count}; rerun with threadCount {len(saved)} or --restart")
+            log("INFO", f"Resuming {tbl['sourceTable']} from saved checkpoint")
+            return [None if done else (decode_key(checkpoint or lower), decode_key(upper)) for lower, upper, checkpoint, done in saved]
+
+        lower = None
+        if args.incremental:
+            row = conn.execute("SELECT watermark FROM watermarks WHERE policy = ? AND source_table = ?", (policy_id, tid)).fetchone()
+            if row:
+                lower = decode_key(row[0])
+                log("INFO", f"Incremental run of {tbl['sourceTable']} after {lower}")
+        ranges = shard_ranges(tbl, shard_count, size, lower)
+        conn.executemany(
+            "INSERT INTO checkpoints (policy, source_table, range_idx, lower, upper, checkpoint, done) VALUES (?, ?, ?, ?, ?, NULL, ?)",
+            [(policy_id, tid, k, encode_key(r[0]) if r else None, encode_key(r[1]) if r else None, 0 if r else 1) for k, r in enumerate(ranges)],
+        )
+        conn.commit()
+        return ranges
+    finally:
+        conn.close()
+
+def save_checkpoint(tbl, key, done=False):
+    # Replays touch scattered rows, so they never move the checkpoint
+    if not state_path or args.replay:
+        return
+    conn = state_db()
+    try:
+        if key is not None:
+            conn.execute("UPDATE checkpoints SET checkpoint = ? WHERE policy = ? AND source_table = ? AND range_idx = ?", (encode_key(key), policy_id, table_id(tbl), shard_index))
+        if done:
+            conn.execute("UPDATE checkpoints SET done = 1 WHERE policy = ? AND source_table = ? AND range_idx = ?", (policy_id, table_id(tbl), shard_index))
+        conn.commit()
+    finally:
+        conn.close()
+
+def finish_table(tbl, failed=0):
+    # Promote the highest checkpoint to the watermark once every range is done. Returns whether
+    # the table is complete. Failed rows with no bad record file to replay them from keep the
+    # previous watermark, so --incremental reads them again instead of skipping them for good.
+    if not state_path:
+        return True
+    conn = state_db()
+    try:
+        tid = table_id(tbl)
+        saved = conn.execute("SELECT checkpoint, done FROM checkpoints WHERE policy = ? AND source_table = ? ORDER BY range_idx", (policy_id, tid)).fetchall()
+        if not saved or not all(done for _, done in saved):
+            return False
+        reached = [checkpoint for checkpoint, _ in saved if checkpoint]
+        if failed and not bad_record_path:
+            log("WARNING", f"{tbl['sourceTable']}: {failed} row(s) failed and createBadRecordFile is off; the watermark stays where it was so --incremental retries them"
+                       + ("" if table_write_mode(tbl) != 'insert' else " (use writeMode upsert so rows already written are not duplicated)"))
+        elif reached:
+            conn.execute("INSERT OR REPLACE INTO watermarks (policy, source_table, watermark, updated_at) VALUES (?, ?, ?, ?)", (policy_id, tid, reached[-1], get_timestamp()))
+        conn.execute("DELETE FROM checkpoints WHERE policy = ? AND source_table = ?", (policy_id, tid))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+# === Bad Record File ===
+# With createBadRecordFile, every row that fails in VTS is appended to badRecordFile as one JSON
+# line: the table, the row's key columns, the failing action and template, the error class, HTTP
+# status and message. Only keys are written, never column values. --replay moves this policy's
+# lines aside, reads those rows back from the source by key and sends them through the same
+# tokenize and write path; rows that fail again are appended to a fresh bad record file.
+replay_keys = {}
+
+def write_bad_records(tbl, keys, failed):
+    if not bad_record_path or not failed:
+        return
+    key_names = get_key_columns(tbl)
+    lines = []
+    for pos, info in sorted(failed.items()):
+        lines.append(json.dumps({
+            'time': get_timestamp(),
+            'policy': policy_id,
+            'table': table_id(tbl),
+            'key': dict(zip(key_names, [tag_value(v) for v in keys[pos]])),
+            **info,
+        }) + '\n')
+    # One O_APPEND write per chunk, so lines from shard processes never interleave
+    fd = os.open(bad_record_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    try:
+        os.write(fd, ''.join(lines).encode('utf-8'))
+    finally:
+        os.close(fd)
+    inc('bdt_bad_records_total', len(lines), table=tbl['sourceTable'])
+
+def load_bad_records():
+    # Returns ({table_id: [key, ...]}, [replay files]). This policy's lines are moved into a new
+    # <file>.<policy>.<time>.<pid>.replayed and the bad record file keeps every other policy's lines,
+    # so new failures start a fresh file. Replay files left by an interrupted replay are read again;
+    # they are deleted only after a replay finishes without table errors.
+    if not bad_record_path:
+        raise RuntimeError("--replay needs createBadRecordFile in the policy")
+    prefix = f"{bad_record_path}.{policy_id}."
+    files = sorted(glob.glob(glob.escape(prefix) + '*.replayed'))
+    if os.path.exists(bad_record_path):
+        with open(bad_record_path, 'r', encoding='utf-8') as f:
+            lines = [line for line in f if line.strip()]
+        mine = [line for line in lines if json.loads(line).get('policy') == policy_id]
+        if mine:
+            replayed = f"{prefix}{datetime.now():%Y%m%d%H%M%S}.{os.getpid()}.replayed"
+            fd = os.open(replayed, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(fd, ''.join(mine).encode('utf-8'))
+            finally:
+                os.close(fd)
+            others = [line for line in lines if json.loads(line).get('policy') != policy_id]
+            if others:
+                tmp = f"{bad_record_path}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.writelines(others)
+                os.replace(tmp, bad_record_path)
+            else:
+                os.remove(bad_record_path)
+            files.append(replayed)
+    if not files:
+        raise RuntimeError(f"No bad records for policy {policy_id} in {bad_record_path}")
+    keys, seen = {}, set()
+    for path in files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                ident = (record['table'], json.dumps(record['key'], sort_keys=True))
+                if ident not in seen:
+                    seen.add(ident)
+                    keys.setdefault(record['table'], []).append({k: untag_value(v) for k, v in record['key'].items()})
+    log("INFO", f"Replaying {len(seen)} bad record(s) from {', '.join(files)}")
+    return keys, files
+
+def fetch_replay_chunks(tbl):
+    # Re-read the recorded rows from the source by key, a few hundred keys per query
+    key_names = get_key_columns(tbl)
+    key_cols = [column(k) for k in key_names]
+    src = table(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)
+    projection = [column(c) for c in get_plan(tbl)['columns']]
+    keys = replay_keys.get(table_id(tbl), [])
+    step = max(1, min(batch_size, 1000 // len(key_names)))
+    for i in range(0, len(keys), step):
+        match = or_(*[and_(*[c == key[k] for c, k in zip(key_cols, key_names)]) for key in keys[i:i + step]])
+        started = time.monotonic()
+        with engine_src.connect() as conn:
+            chunk = [list(r) for r in conn.execute(select(*projection).select_from(src).where(match).order_by(*key_cols))]
+        observe('bdt_fetch_seconds', time.monotonic() - started, table=tbl['sourceTable'])
+        inc('bdt_rows_read_total', len(chunk), table=tbl['sourceTable'])
+        if len(chunk) < len(keys[i:i + step]):
+            log("WARNING", f"{tbl['sourceTable']}: {len(keys[i:i + step]) - len(chunk)} bad record key(s) no longer in the source")
+        if chunk:
+            yield chunk
+
+# === VTS Client ===
+def make_vts_client():
+    # One pooled client for the whole run, so rows reuse keep-alive connections instead of a new handshake each
+    limits = httpx.Limits(
+        max_connections=vts_budget,
+        max_keepalive_connections=vts.get('maxKeepaliveConnections', 100),
+        keepalive_expiry=vts.get('keepaliveExpiry', 30.0),
+    )
+    timeout = httpx.Timeout(
+        vts.get('readTimeout', 10.0),
+        connect=vts.get('connectTimeout', 5.0),
+        pool=vts.get('poolTimeout', 30.0),
+    )
+    http2 = vts.get('http2', False)
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            log("WARNING", "http2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+    return httpx.AsyncClient(verify=False, auth=vts_auth, headers=headers, limits=limits, timeout=timeout, http2=http2)
+
+# === VTS Nodes ===
+# vts.nodes lists the cluster members, as objects with tokenUrl/detokenUrl (and optionally healthUrl),
+# or as base URLs that take their paths from the top-level tokenUrl/detokenUrl. Without nodes the
+# top-level URLs are the only node. Every attempt goes to the healthy node with the fewest requests
+# outstanding (ties broken at random), so faster nodes take more of the load. A node is taken out of
+# rotation after nodeFailureThreshold transient failures in a row, and a background check GETs
+# each node's healthUrl (default: its tokenUrl) every healthCheckInterval seconds: any answer
+# below HTTP 500 puts it back, no answer or a 5xx takes it out. A node's failures reach the circuit
+# breaker and the concurrency limit only while no other node is healthy; while every node is out,
+# requests go to all of them and the circuit breaker decides.
+class VTSNode:
+    def __init__(self, token_url, detoken_url, health_url=None):
+        self.token_url = token_url
+        self.detoken_url = detoken_url
+        self.health_url = health_url or token_url
+        self.name = urlsplit(token_url).netloc or token_url
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+
+    def url(self, action):
+        return self.token_url if action == 'TOKENIZE' else self.detoken_url
+
+def parse_vts_nodes():
+    nodes = []
+    for node in vts.get('nodes') or []:
+        if isinstance(node, str):
+            base = node.rstrip('/')
+            nodes.append(VTSNode(base + (urlsplit(vts.get('tokenUrl', '')).path or '/vts/tokenize'),
+                                 base + (urlsplit(vts.get('detokenUrl', '')).path or '/vts/detokenize')))
+        else:
+            nodes.append(VTSNode(node['tokenUrl'], node['detokenUrl'], node.get('healthUrl')))
+    return nodes or [VTSNode(vts['tokenUrl'], vts['detokenUrl'], vts.get('healthUrl'))]
+
+vts_nodes = parse_vts_nodes()
+node_failure_threshold = vts.get('nodeFailureThreshold', 3)
+health_check_interval = vts.get('healthCheckInterval', 5.0)
+
+def pick_node():
+    candidates = [n for n in vts_nodes if n.healthy] or vts_nodes
+    fewest = min(n.outstanding for n in candidates)
+    node = random.choice([n for n in candidates if n.outstanding == fewest])
+    node.outstanding += 1
+    return node
+
+def set_node_health(node, healthy, reason):
+    if healthy == node.healthy or len(vts_nodes) == 1:
+        return
+    node.healthy = healthy
+    node.failures = 0
+    if healthy:
+        log("INFO", f"VTS node {node.name} back in rotation ({reason})")
+    else:
+        inc('bdt_vts_node_ejections_total', node=node.name, **shard_labels())
+        log("WARNING", f"VTS node {node.name} taken out of rotation ({reason}), {sum(n.healthy for n in vts_nodes)} of {len(vts_nodes)} healthy")
+
+def node_done(node, latency, ok):
+    # ok=None (a cancelled request) leaves the node's stats and health alone. Returns whether the
+    # outcome also counts for the circuit breaker and the concurrency limit: a failure only does when
+    # no other node is healthy, so one dead node is taken out without throttling the healthy ones
+    node.outstanding -= 1
+    if ok is None:
+        return False
+    observe('bdt_vts_node_seconds', latency, node=node.name)
+    inc('bdt_vts_node_requests_total', node=node.name, outcome='ok' if ok else 'error')
+    if ok:
+        node.failures = 0
+        return True
+    node.failures += 1
+    if node.healthy and node.failures >= node_failure_threshold:
+        set_node_health(node, False, f"{node.failures} failures in a row")
+    return not any(n.healthy for n in vts_nodes if n is not node)
+
+async def check_node(client, node):
+    try:
+        res = await client.get(node.health_url, timeout=vts.get('connectTimeout', 5.0))
+        healthy, reason = res.status_code < 500, f"health check HTTP {res.status_code}"
+    except httpx.HTTPError as e:
+        healthy, reason = False, f"health check {type(e).__name__}"
+    set_node_health(node, healthy, reason)
+
+async def health_checks(client):
+    while True:
+        await asyncio.sleep(health_check_interval)
+        await asyncio.gather(*(check_node(client, n) for n in vts_nodes))
+
+# === Concurrency Control ===
+class AdaptiveLimiter:
+    # AIMD limit on in-flight VTS requests between minConcurrency and maxConnections. Each successful
+    # request at normal latency adds 1/limit (about +1 per round trip); a 429/5xx/timeout halves the
+    # limit and latency above latencyTolerance x the baseline trims it by 10%. Latency grows with bulk
+    # size, so there is one baseline per power-of-two bucket of items per request and a small tail or
+    # retry bulk never makes full bulks look slow. Only requests started after the last decrease can
+    # trigger another one, so one burst of errors counts once.
+    def __init__(self, floor, ceiling, initial):
+        self.floor = max(1, min(floor, ceiling))
+        self.ceiling = ceiling
+        self.limit = float(min(max(initial, self.floor), ceiling))
+        self.in_flight = 0
+        self.baselines = {}
+        self.last_decrease = 0.0
+        self.logged_at = 0.0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        set_gauge('bdt_vts_in_flight_max', self.in_flight, high_water=True, **shard_labels())
+        return time.monotonic()
+
+    async def release(self, started, overloaded, items=1):
+        # overloaded=None (a cancelled request) only frees the slot
+        if overloaded is None:
+            async with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+            return
+        latency = time.monotonic() - started
+        before = int(self.limit)
+        if not overloaded:
+            # Each bucket's baseline follows its fastest recent round trips and drifts up 1% per sample
+            bucket = items.bit_length()
+            baseline = self.baselines.get(bucket)
+            baseline = self.baselines[bucket] = latency if baseline is None else min(latency, baseline * 1.01)
+        slow = not overloaded and latency > baseline * latency_tolerance
+        if overloaded or slow:
+            if started > self.last_decrease:
+                self.limit = max(self.floor, self.limit * (0.5 if overloaded else 0.9))
+                self.last_decrease = time.monotonic()
+        else:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+        # Only a release that moved the limit logs: every decrease, increases at most every 2s
+        after = int(self.limit)
+        if after != before and (after < before or time.monotonic() - self.logged_at >= 2):
+            log("INFO", f"VTS concurrency {before} -> {after} ({'overloaded' if overloaded else f'{latency * 1000:.0f}ms'})")
+            self.logged_at = time.monotonic()
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+# === Retry Policy ===
+# Transient failures (connection errors, timeouts, HTTP 408/429/5xx) are retried with decorrelated
+# jitter: each wait is drawn from [retryBaseDelay, 3 x the previous wait], capped at retryMaxDelay,
+# so coroutines that failed together do not retry together. A Retry-After header sets the minimum
+# wait. Retries draw on a budget shared by the process: every request adds retryBudget (a fraction)
+# and every retry spends 1, from a reserve of retryBudgetReserve, so a VTS outage cannot turn into
+# a retry storm. After breakerThreshold transient failures in a row the circuit breaker opens and
+# dispatch pauses for breakerCooldown seconds; then one probe request is let through, and the
+# breaker closes on its success or opens again on its failure.
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+vts_retries = vts.get('retries', 5)
+retry_base_delay = vts.get('retryBaseDelay', 0.2)
+retry_max_delay = vts.get('retryMaxDelay', 20.0)
+item_retries = vts.get('itemRetries', 1)
+
+class VTSUnavailable(RuntimeError):
+    pass
+
+class RetryBudget:
+    def __init__(self, ratio, reserve):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        if self.exhausted == 1:
+            log("WARNING", "VTS retry budget exhausted, failing requests instead of retrying")
+        return False
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        # Set while closed; waiters wake as soon as a success closes the breaker, not at the end of the cooldown
+        self.closed = asyncio.Event()
+        self.closed.set()
+
+    async def wait(self):
+        while self.threshold and self.failures >= self.threshold:
+            remaining = self.open_until - time.monotonic()
+            if remaining <= 0 and not self.probing:
+                self.probing = True
+                return
+            try:
+                await asyncio.wait_for(self.closed.wait(), remaining if remaining > 0 else min(0.1, self.cooldown))
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, ok):
+        # ok=None (a cancelled request) only gives up the probe slot.
+        # Requests already in flight when the breaker opened only add to the count; the breaker
+        # opens when the threshold is reached and reopens only when the probe fails
+        probe, self.probing = self.probing, False
+        if ok is None:
+            return
+        if ok:
+            if self.threshold and self.failures >= self.threshold:
+                log("INFO", "VTS circuit breaker closed")
+            self.failures = 0
+            self.closed.set()
+            return
+        self.failures += 1
+        if self.threshold and (self.failures == self.threshold or probe):
+            self.open_until = time.monotonic() + self.cooldown
+            self.closed.clear()
+            inc('bdt_vts_breaker_open_total', **shard_labels())
+            log("WARNING", f"VTS circuit breaker {'reopened' if probe else 'opened'} after {self.failures} failures, pausing requests for {self.cooldown:g}s")
+
+retry_budget = RetryBudget(vts.get('retryBudget', 0.2), vts.get('retryBudgetReserve', 20))
+breaker = CircuitBreaker(vts.get('breakerThreshold', 5), vts.get('breakerCooldown', 10.0))
+
+def retry_after_seconds(res):
+    value = res.headers.get('Retry-After') if res is not None else None
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return 0.0
+
+async def post_with_retry(client, limiter, action, body, headers, labels=None, items=1):
+    # Returns the last response, which may still be a retryable error status once retries run out;
+    # transport errors are raised after the last attempt. Each attempt picks its node afresh.
+    # items is the number of values in the bulk, for the limiter's latency baseline.
+    labels = labels or {}
+    delay = retry_base_delay
+    retry_budget.deposit()
+    for attempt in range(vts_retries + 1):
+        if attempt:
+            if not retry_budget.withdraw():
+                raise VTSUnavailable(f"retry budget exhausted ({reason})")
+            inc('bdt_vts_retries_total', **labels)
+        await breaker.wait()
+        started = await limiter.acquire()
+        node = pick_node()
+        overloaded = True
+        res = None
+        try:
+            res = await client.post(node.url(action), content=body, headers=headers)
+            overloaded = res.status_code in RETRYABLE_STATUS
+            observe('bdt_vts_request_seconds', time.monotonic() - started, **labels)
+            inc('bdt_vts_requests_total', status=res.status_code, **labels)
+            if not overloaded or attempt == vts_retries:
+                return res
+            reason = f"HTTP {res.status_code}"
+        except httpx.TransportError as e:
+            if attempt == vts_retries:
+                raise
+            reason = type(e).__name__
+        except asyncio.CancelledError:
+            # Cancellation says nothing about VTS health
+            overloaded = None
+            raise
+        finally:
+            if not node_done(node, time.monotonic() - started, None if overloaded is None else not overloaded):
+                # Cancelled, or a failure another healthy node can absorb
+                overloaded = None
+            breaker.record(None if overloaded is None else not overloaded)
+            await limiter.release(started, overloaded, items)
+        if overloaded is None:
+            # Another node is healthy, so retry straight away without backing off
+            log("DEBUG", f"VTS {reason} from node {node.name}, retry {attempt + 1}/{vts_retries} now")
+            continue
+        delay = min(retry_max_delay, random.uniform(retry_base_delay, delay * 3))
+        wait = max(delay, retry_after_seconds(res))
+        log("DEBUG", f"VTS {reason}, retry {attempt + 1}/{vts_retries} in {wait:.2f}s")
+        await asyncio.sleep(wait)
+
+# === Token Cache ===
+# Bounded LRU keyed by (action, tokengroup, tokentemplate, value). DETOKENIZE is always deterministic,
+# TOKENIZE only for templates listed in tokenCache.deterministicTemplates. TOKENIZE results can also be
+# persisted to a local SQLite file (tokenCache.path) so reruns skip values already paid for.
+token_cache = OrderedDict()
+cache_stats = {'hits': 0, 'misses': 0}
+cache_store = None
+
+def is_cacheable(action, template):
+    return cache_max_entries > 0 and (action == 'DETOKENIZE' or template in cache_templates)
+
+def store_key(key):
+    return hmac.new(cache_key, repr(key).encode('utf-8'), hashlib.sha256).hexdigest()
+
+def open_cache_store():
+    global cache_store
+    if cache_cfg.get('path') and cache_max_entries > 0:
+        cache_store = sqlite3.connect(cache_cfg['path'], timeout=30)
+        cache_store.execute("CREATE TABLE IF NOT EXISTS token_cache (key TEXT PRIMARY KEY, value TEXT)")
+
+def close_cache_store():
+    global cache_store
+    if cache_store is not None:
+        cache_store.commit()
+        cache_store.close()
+        cache_store = None
+
+def cache_put(key, value):
+    token_cache[key] = value
+    token_cache.move_to_end(key)
+    if len(token_cache) > cache_max_entries:
+        token_cache.popitem(last=False)
+
+def cache_get_many(action, group, template, values, counts=None):
+    # counts maps each distinct value to the number of row values it stands for. Stats are per row
+    # value: one miss per distinct value that has to go to VTS, hits for everything else, including
+    # repeats in the chunk that share that one request.
+    found, missing = {}, []
+    for value in values:
+        key = (action, group, template, value)
+        if key in token_cache:
+            token_cache.move_to_end(key)
+            found[value] = token_cache[key]
+        else:
+            missing.append(value)
+
+    if cache_store is not None and action == 'TOKENIZE' and missing:
+        hashed = {store_key((action, group, template, v)): v for v in missing}
+        keys = list(hashed)
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            rows = cache_store.execute(f"SELECT key, value FROM token_cache WHERE key IN ({', '.join('?' * len(part))})", part)
+            for k, token in rows:
+                found[hashed[k]] = token
+                cache_put((action, group, template, hashed[k]), token)
+
+    total = sum(counts.values()) if counts else len(values)
+    misses = len(values) - len(found)
+    cache_stats['hits'] += total - misses
+    cache_stats['misses'] += misses
+    return found
+
+def cache_store_many(action, group, template, pairs):
+    for value, result in pairs:
+        cache_put((action, group, template, value), result)
+    if cache_store is not None and action == 'TOKENIZE' and pairs:
+        cache_store.executemany(
+            "INSERT OR REPLACE INTO token_cache (key, value) VALUES (?, ?)",
+            [(store_key((action, group, template, v)), r) for v, r in pairs],
+        )
+
+# === Local FPE Backend ===
+# Templates listed in crypto.templates are transformed in-process instead of by VTS, for masking
+# non-production copies without the network round trip. The cipher is an FF1-shaped Feistel
+# network (10 rounds, unbalanced halves, modular addition in the character set's radix) with
+# HMAC-SHA256 as round function, keyed by PBKDF2 of crypto.pin and tweaked by tokenGroup and
+# tokenTemplate. Characters outside the template's character set stay where they are, so an
+# email keeps its @ and dots. It is deterministic and reversible (DETOKENIZE decrypts), but it is
+# not a NIST-validated FF1/FF3-1 implementation.
+FPE_ROUNDS = 10
+fpe_alphabets = {}
+
+def fpe_alphabet(template):
+    if template not in fpe_alphabets:
+        alphabet = character_sets[fpe_templates[template]]
+        fpe_alphabets[template] = (alphabet, {ch: i for i, ch in enumerate(alphabet)})
+    return fpe_alphabets[template]
+
+def fpe_round(prf, n, i, num, modulus):
+    # Round function output reduced mod radix^m, with 64 extra bits so the reduction is unbiased
+    msg = n.to_bytes(4, 'big') + bytes([i]) + num.to_bytes((num.bit_length() + 7) // 8 or 1, 'big')
+    y = 0
+    for block in range((modulus.bit_length() + 64 + 255) // 256):
+        h = prf.copy()
+        h.update(msg + bytes([block]))
+        y = (y << 256) | int.from_bytes(h.digest(), 'big')
+    return y % modulus
+
+def fpe_numerals(numerals, radix, prf, decrypt):
+    n = len(numerals)
+    if n == 1:
+        shift = fpe_round(prf, 1, 0, 0, radix)
+        return [(numerals[0] + (-shift if decrypt else shift)) % radix]
+    u, v = n // 2, n - n // 2
+    a = b = 0
+    for d in numerals[:u]:
+        a = a * radix + d
+    for d in numerals[u:]:
+        b = b * radix + d
+    rounds = range(FPE_ROUNDS - 1, -1, -1) if decrypt else range(FPE_ROUNDS)
+    for i in rounds:
+        modulus = radix ** (u if i % 2 == 0 else v)
+        if decrypt:
+            a, b = (b - fpe_round(prf, n, i, a, modulus)) % modulus, a
+        else:
+            a, b = b, (a + fpe_round(prf, n, i, b, modulus)) % modulus
+    out = []
+    for num, m in ((a, u), (b, v)):
+        part = [0] * m
+        for j in range(m - 1, -1, -1):
+            num, part[j] = divmod(num, radix)
+        out.extend(part)
+    return out
+
+def fpe_bulk(action, group, template, values):
+    # Answers like decode_results (values, no failures), so send_bulk maps both backends the same way
+    started = time.monotonic()
+    alphabet, index = fpe_alphabet(template)
+    prf = hmac.new(fpe_key, f"{group}|{template}|".encode('utf-8'), hashlib.sha256)
+    decrypt = action == 'DETOKENIZE'
+    results = []
+    for value in values:
+        if value is None:
+            results.append(None)
+            continue
+        chars = list(str(value))
+        positions = [p for p, ch in enumerate(chars) if ch in index]
+        if positions:
+            for p, d in zip(positions, fpe_numerals([index[chars[p]] for p in positions], len(alphabet), prf, decrypt)):
+                chars[p] = alphabet[d]
+        results.append(''.join(chars))
+    observe('bdt_fpe_seconds', time.monotonic() - started, action=action, template=template)
+    return results, {}
+
+# === Wire Codec ===
+# Request bodies are assembled as bytes: the constant {"tokengroup":...,"tokentemplate":...,"data":
+# prefix of each (action, group, template) is encoded once per run and only the values are
+# serialized per request, once per bulk however often it is retried. Responses are decoded into a
+# plain list of result values plus the positions that failed. vts.codec picks the JSON backend:
+# "orjson" (pip install orjson), "json" (stdlib) or "auto" (orjson when it is installed).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+wire_codec = vts.get('codec', 'auto')
+if wire_codec == 'orjson' and orjson is None:
+    log("WARNING", "codec is orjson but the 'orjson' package is not installed, falling back to json")
+if orjson is not None and wire_codec != 'json':
+    def dumps(value):
+        return orjson.dumps(value, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    loads = orjson.loads
+else:
+    json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def dumps(value):
+        return json_encoder.encode(value).encode('utf-8')
+    loads = json.loads
+
+payload_prefixes = {}
+
+def encode_bulk(action, group, template, values):
+    prefix = payload_prefixes.get((action, group, template))
+    if prefix is None:
+        prefix = payload_prefixes[(action, group, template)] = (
+            b'{"tokengroup":' + dumps(group) + b',"tokentemplate":' + dumps(template) + b',"' + PAYLOAD_KEY[action].encode('ascii') + b'":')
+    return b'[' + b','.join([prefix + dumps(v) + b'}' for v in values]) + b']'
+
+def decode_results(action, body, count):
+    # Returns the result value per item (None where the item failed) and {position: reason} for failures
+    items = loads(body)
+    if not isinstance(items, list) or len(items) != count:
+        raise RuntimeError(f"VTS returned {len(items) if isinstance(items, list) else 'no list of'} items for a bulk of {count}")
+    key = RESULT_KEY[action]
+    values, errors = [None] * count, {}
+    for n, item in enumerate(items):
+        if key in item:
+            values[n] = item[key]
+        else:
+            errors[n] = str(item.get('reason') or item.get('status'))[:200]
+    return values, errors
+
+# === Tokenize / Detokenize Logic ===
+RESULT_KEY = {'TOKENIZE': 'token', 'DETOKENIZE': 'data'}
+PAYLOAD_KEY = {'TOKENIZE': 'data', 'DETOKENIZE': 'token'}
+
+def screen_values(tbl, rows, failed):
+    # Pre-filter, one column at a time: NULL and empty values stay as they are, and values with a
+    # character outside the template's templateCharacterSets entry fail their row without any HTTP
+    # call. Returns the (row position, column position, value) items per group that still need VTS;
+    # rows that failed in any column send nothing.
+    plan = get_plan(tbl)
+    screened = {}
+    for (action, group, template), positions in plan['groups'].items():
+        invalid = template_validators.get(template)
+        items, empty, rejected = [], 0, 0
+        for i in positions:
+            for pos, row in enumerate(rows):
+                value = row[i]
+                if value is None or value == '':
+                    empty += 1
+                elif invalid is not None and invalid.search(value if isinstance(value, str) else str(value)):
+                    rejected += 1
+                    failed.setdefault(pos, {'action': action, 'template': template, 'column': plan['columns'][i], 'error': 'InvalidCharacter',
+                                            'status': None, 'message': f"value has characters outside {template_charsets[template]}"})
+                else:
+                    items.append((pos, i, value))
+        if empty:
+            inc('bdt_values_skipped_total', empty, reason='empty', template=template)
+        if rejected:
+            inc('bdt_values_skipped_total', rejected, reason='invalid', template=template)
+        screened[(action, group, template)] = items
+    if failed:
+        screened = {k: [item for item in items if item[0] not in failed] for k, items in screened.items()}
+    return screened
+
+def build_bulk_requests(tbl, rows, failed):
+    # Pack values from every row of the chunk into one request per (action, tokengroup, tokentemplate),
+    # split into requests of at most bulk_size items. targets maps each item back to its (row position, column
+    # position) pairs; cacheable values are deduplicated and cache hits are filled in without reaching VTS.
+    for (action, group, template), items in screen_values(tbl, rows, failed).items():
+        if is_cacheable(action, template):
+            by_value = {}
+            for pos, i, value in items:
+                by_value.setdefault(value, []).append((pos, i))
+            counts = {value: len(targets) for value, targets in by_value.items()}
+            for value, result in cache_get_many(action, group, template, list(by_value), counts).items():
+                for pos, i in by_value.pop(value):
+                    rows[pos][i] = result
+            values = list(by_value)
+            targets = [by_value[v] for v in values]
+        else:
+            values = [value for _, _, value in items]
+            targets = [[(pos, i)] for pos, i, _ in items]
+
+        for i in range(0, len(values), bulk_size):
+            yield action, group, template, targets[i:i + bulk_size], values[i:i + bulk_size]
+
+async def call_backend(client, limiter, action, group, template, values):
+    # One bulk through local FPE or VTS; returns (HTTP status or None, result values, {position: reason})
+    if template in fpe_templates:
+        # Local backend, run off the event loop so VTS-bound requests keep flowing
+        results, errors = await asyncio.get_event_loop().run_in_executor(None, fpe_bulk, action, group, template, values)
+        return None, results, errors
+    res = await post_with_retry(client, limiter, action, encode_bulk(action, group, template, values), headers,
+                                labels={'action': action, 'template': template}, items=len(values))
+    try:
+        res.raise_for_status()
     except httpx.HTTPStatusError as e:
-        log("ERROR", f"Row {idx} HTTP error: {e.response.status_code} - {e.response.text}")
-        return (idx, None)
+        log("ERROR", f"{action} bulk of {len(values)} HTTP status {e.response.status_code}: {e.response.text[:200]}")
+        raise
+    started = time.monotonic()
+    results, errors = decode_results(action, res.content, len(values))
+    observe('bdt_vts_decode_seconds', time.monotonic() - started, action=action)
+    return res.status_code, results, errors
+
+def splittable(e):
+    # A bulk that failed as a whole is split in two unless VTS itself is out of reach, throttling or refusing us;
+    # halving isolates a value that breaks the request and shrinks bulks that time out
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return not isinstance(e, (VTSUnavailable, httpx.ConnectError, httpx.PoolTimeout)) and status not in (401, 403, 429)
+
+async def send_bulk(client, limiter, action, group, template, targets, values, rows, failed, column_names, retries_left=None):
+    retries_left = item_retries if retries_left is None else retries_left
+    try:
+        status, results, errors = await call_backend(client, limiter, action, group, template, values)
+    except Exception as e:
+        if len(values) > 1 and splittable(e):
+            half = len(values) // 2
+            inc('bdt_vts_splits_total', action=action, template=template)
+            log("WARNING", f"{action} bulk of {len(values)} failed ({type(e).__name__}), retrying as {half} + {len(values) - half}")
+            await asyncio.gather(
+                send_bulk(client, limiter, action, group, template, targets[:half], values[:half], rows, failed, column_names, retries_left),
+                send_bulk(client, limiter, action, group, template, targets[half:], values[half:], rows, failed, column_names, retries_left))
+            return
+        log("ERROR", f"{action} bulk of {len(values)} failed: {e}")
+        response = getattr(e, 'response', None)
+        info = {'action': action, 'template': template, 'column': column_names[targets[0][0][1]], 'error': type(e).__name__,
+                'status': getattr(response, 'status_code', None), 'message': str(e)[:200]}
+        for target in targets:
+            for pos, _ in target:
+                failed.setdefault(pos, info)
+        return
+
+    resolved, retry = [], []
+    for n, (value, target, result) in enumerate(zip(values, targets, results)):
+        if n not in errors:
+            for pos, i in target:
+                rows[pos][i] = result
+            resolved.append((value, result))
+        elif retries_left and status is not None:
+            retry.append(n)
+        else:
+            info = {'action': action, 'template': template, 'column': column_names[target[0][1]], 'error': 'VTSItemError',
+                    'status': status, 'message': errors[n]}
+            for pos, _ in target:
+                failed.setdefault(pos, info)
+    if is_cacheable(action, template):
+        cache_store_many(action, group, template, resolved)
+    if retry:
+        # Only the items that failed are sent again, as one smaller bulk
+        log("WARNING", f"{action} bulk of {len(values)}: {len(retry)} item(s) failed, retrying them")
+        await send_bulk(client, limiter, action, group, template, [targets[n] for n in retry], [values[n] for n in retry],
+                        rows, failed, column_names, retries_left - 1)
+
+async def process_chunk(client, limiter, tbl, offset, rows, record=True):
+    # record=False (used by --plan) leaves the bad record file and the chunk metrics alone
+    failed = {}
+    started = time.monotonic()
+    plan = get_plan(tbl)
+    # Keys are copied up front in case a key column is itself tokenized; bad records and checkpoints
+    # always name the source key, never its token
+    keys = [[row[i] for i in plan['keys']] for row in rows]
+
+    await asyncio.gather(*(send_bulk(client, limiter, *req, rows, failed, plan['columns']) for req in build_bulk_requests(tbl, rows, failed)))
+    if record:
+        observe('bdt_tokenize_chunk_seconds', time.monotonic() - started, table=tbl['sourceTable'])
+        inc('bdt_rows_failed_total', len(failed), table=tbl['sourceTable'])
+        write_bad_records(tbl, keys, failed)
+
+    # Only column names are logged, never plaintext or token values
+    transformed = ', '.join(f"{col['action']} {col['name']}" for col in tbl['columns'] if col['action'] in RESULT_KEY)
+    results = []
+    for pos, row in enumerate(rows):
+        if pos in failed:
+            log_row("ERROR", f"{tbl['sourceTable']}: failed in bulk request", offset + pos)
+            results.append((offset + pos, None, keys[pos]))
+            continue
+        log_row("SUCCESS", f"{tbl['sourceTable']}: processed {transformed}", offset + pos)
+        results.append((offset + pos, row, keys[pos]))
+    return results
+
+# === Destination Writers ===
+def dest_table(tbl, cols):
+    return table(tbl['destinationTable'], *[column(c) for c in cols], schema=tbl['destinationSchema'] or None)
+
+def pg_text(value):
+    # PostgreSQL input text for a non-NULL value, matching what psycopg2 would have bound: lists as
+    # array literals, dicts as JSON (json/jsonb), timedeltas as intervals
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return pg_array(value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, timedelta):
+        return f"{value.days} days {value.seconds}.{value.microseconds:06d} seconds"
+    return str(value)
+
+def pg_array(values):
+    # Elements are double-quoted, except NULL and nested arrays (multidimensional arrays)
+    items = []
+    for v in values:
+        if v is None:
+            items.append('NULL')
+        elif isinstance(v, (list, tuple)):
+            items.append(pg_array(v))
+        else:
+            items.append('"' + pg_text(v).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+def copy_text_value(value):
+    if value is None:
+        return '\\N'
+    return pg_text(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def write_copy(conn, target, cols, rows):
+    # PostgreSQL: COPY FROM STDIN (text format) on the raw psycopg2 cursor
+    preparer = conn.dialect.identifier_preparer
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join([copy_text_value(v) for v in row]))
+        buf.write('\n')
+    buf.seek(0)
+    sql = f"COPY {preparer.format_table(target)} ({', '.join(preparer.quote(c) for c in cols)}) FROM STDIN"
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
+
+def write_multirow(conn, target, cols, rows):
+    # MySQL / MariaDB: multi-row INSERT ... VALUES (...), (...), kept under the driver's parameter limits
+    step = max(1, min(1000, 60000 // len(cols)))
+    for i in range(0, len(rows), step):
+        conn.execute(insert(target).values(rows[i:i + step]))
+
+def write_executemany(conn, target, cols, rows):
+    # SQL Server (fast_executemany on the engine), SQLite and everything else. Positional drivers get
+    # the row lists as they are; named-parameter drivers need a dict per row.
+    compiled = insert(target).compile(dialect=conn.dialect, column_keys=cols)
+    if compiled.positional:
+        conn.exec_driver_sql(str(compiled), [tuple(row) for row in rows])
+    else:
+        conn.execute(insert(target), [dict(zip(cols, row)) for row in rows])
+
+def get_writer():
+    if dest_backend == 'postgresql' and dest_driver == 'psycopg2':
+        return write_copy
+    if dest_backend in ('mysql', 'mariadb'):
+        return write_multirow
+    return write_executemany
+
+def insert_rows(tbl, data_ready):
+    # One transaction per commit chunk. begin() is explicit because write_copy only touches the raw
+    # DBAPI cursor, which would not autobegin a SQLAlchemy transaction for commit() to act on.
+    started = time.time()
+    plan = get_plan(tbl)
+    with engine_dest.begin() as conn:
+        cols = plan['write']
+        get_writer()(conn, dest_table(tbl, cols), cols, project(data_ready, plan['write_idx']))
+    elapsed = time.time() - started
+    observe('bdt_insert_seconds', elapsed, table=tbl['destinationTable'])
+    inc('bdt_rows_written_total', len(data_ready), table=tbl['destinationTable'])
+    log("INFO", f"Committed {len(data_ready)} rows to {tbl['destinationTable']} in {elapsed:.2f}s ({len(data_ready) / max(elapsed, 1e-6):.0f} rows/s)")
+
+# === Destination Setup ===
+# createDestinationTable mirrors the source columns before the load, without a primary key or
+# indexes, so rows go into a bare table. Transformed columns become strings of at least
+# tokenColumnLength characters, since tokens can be longer than the values they replace. Once the
+# table is complete, the unique key (createUniqueKey, on the source's primary key or keyColumns)
+# and the source's single-column and composite indexes are built in one pass. Indexes that already
+# exist are skipped, so resumed and incremental runs only add what is missing.
+token_length = config.get('tokenColumnLength', 255)
+
+def create_destination(tbl):
+    if not tbl.get('createDestinationTable') or in_place:
+        return
+    schema, name = tbl['destinationSchema'] or None, tbl['destinationTable']
+    if inspect(engine_dest).has_table(name, schema=schema):
+        log("INFO", f"{name} already exists, not creating it")
+        return
+    source = Table(tbl['sourceTable'], MetaData(), autoload_with=engine_src, schema=tbl['sourceSchema'] or None)
+    transformed = set(transformed_columns(tbl))
+    columns = []
+    for col in source.columns:
+        if col.name in transformed:
+            col_type = String(max(getattr(col.type, 'length', None) or 0, token_length))
+        else:
+            try:
+                col_type = col.type.as_generic()
+            except NotImplementedError:
+                col_type = col.type
+        columns.append(Column(col.name, col_type, nullable=col.nullable))
+    Table(name, MetaData(), *columns, schema=schema).create(engine_dest)
+    log("INFO", f"Created {name} with {len(columns)} columns; keys and indexes are built after the load")
+
+def build_destination_indexes(tbl, unique_only=False):
+    # unique_only builds just the unique key, before the load, for upserts that need it to match on
+    if in_place or not (tbl.get('createDestinationTable') or tbl.get('createUniqueKey')):
+        return
+    schema, name = tbl['destinationSchema'] or None, tbl['destinationTable']
+    dest = Table(name, MetaData(), autoload_with=engine_dest, schema=schema)
+    existing = {ix['name'] for ix in inspect(engine_dest).get_indexes(name, schema=schema)}
+    wanted = []
+    if tbl.get('createUniqueKey') or table_write_mode(tbl) == 'upsert':
+        keys = get_primary_key(tbl) or tbl.get('keyColumns')
+        if keys:
+            wanted.append((f"uq_{name}_key", keys, True))
+        else:
+            log("WARNING", f"createUniqueKey: {tbl['sourceTable']} has no primary key or keyColumns")
+    if tbl.get('createDestinationTable') and not unique_only:
+        for ix in inspect(engine_src).get_indexes(tbl['sourceTable'], schema=tbl['sourceSchema'] or None):
+            cols = ix['column_names']
+            # Expression indexes and indexes on columns the destination lacks are not copied
+            if cols and all(c is not None and c in dest.c for c in cols):
+                wanted.append((f"ix_{name}_{'_'.join(cols)}", cols, bool(ix.get('unique'))))
+    for ix_name, cols, unique in wanted:
+        ix_name = ix_name[:60]
+        if ix_name in existing:
+            continue
+        started = time.time()
+        try:
+            Index(ix_name, *[dest.c[c] for c in cols], unique=unique).create(engine_dest)
+            log("INFO", f"Built {'unique ' if unique else ''}index {ix_name} on {name} ({', '.join(cols)}) in {time.time() - started:.2f}s")
+        except SQLAlchemyError as e:
+            log("ERROR", f"Could not build index {ix_name} on {name}: {e}")
+
+# === Staged Writes ===
+# In place and in upsert mode, each commit chunk is bulk-loaded (with the dialect's writer above)
+# into a session temp table, then applied with one set-based statement joined on the table's
+# unique key, so the database does a single pass per chunk instead of one statement per row:
+#   in place  UPDATE ... FROM / UPDATE ... JOIN, only the key and transformed columns
+#   upsert    INSERT ... ON CONFLICT (PostgreSQL, SQLite), INSERT ... ON DUPLICATE KEY UPDATE
+#             (MySQL/MariaDB), MERGE (SQL Server). Rerunning a chunk overwrites instead of duplicating.
+def table_write_mode(tbl):
+    return 'update' if in_place else tbl.get('writeMode', write_mode)
+
+def stage_statements(target, select_list):
+    # (stage name, create, drop) for a temp table with the target's column types
+    if dest_backend == 'mssql':
+        return ('#bdt_stage',
+                f"SELECT {select_list} INTO #bdt_stage FROM {target} WHERE 1 = 0",
+                "DROP TABLE IF EXISTS #bdt_stage")
+    if dest_backend in ('mysql', 'mariadb'):
+        return ('bdt_stage',
+                f"CREATE TEMPORARY TABLE bdt_stage AS SELECT {select_list} FROM {target} WHERE 1 = 0",
+                "DROP TEMPORARY TABLE IF EXISTS bdt_stage")
+    return ('bdt_stage',
+            f"CREATE TEMPORARY TABLE bdt_stage AS SELECT {select_list} FROM {target} WHERE 1 = 0",
+            "DROP TABLE IF EXISTS bdt_stage")
+
+def apply_statement(mode, q, target, stage, keys, cols):
+    others = [c for c in cols if c not in keys]
+    join = ' AND '.join(f"t.{q(k)} = s.{q(k)}" for k in keys)
+    col_list = ', '.join(q(c) for c in cols)
+    source_list = ', '.join(f"s.{q(c)}" for c in cols)
+    if mode == 'update':
+        if dest_backend == 'mssql':
+            return f"UPDATE t SET {', '.join(f'{q(c)} = s.{q(c)}' for c in others)} FROM {target} AS t JOIN {stage} AS s ON {join}"
+        if dest_backend in ('mysql', 'mariadb'):
+            return f"UPDATE {target} AS t JOIN {stage} AS s ON {join} SET {', '.join(f't.{q(c)} = s.{q(c)}' for c in others)}"
+        # PostgreSQL, SQLite (3.33+) and others with UPDATE ... FROM
+        return f"UPDATE {target} AS t SET {', '.join(f'{q(c)} = s.{q(c)}' for c in others)} FROM {stage} AS s WHERE {join}"
+    if dest_backend == 'mssql':
+        matched = f" WHEN MATCHED THEN UPDATE SET {', '.join(f't.{q(c)} = s.{q(c)}' for c in others)}" if others else ""
+        return f"MERGE {target} AS t USING {stage} AS s ON {join}{matched} WHEN NOT MATCHED THEN INSERT ({col_list}) VALUES ({source_list});"
+    if dest_backend in ('mysql', 'mariadb'):
+        update = ', '.join(f"{q(c)} = s.{q(c)}" for c in others) or f"{q(keys[0])} = s.{q(keys[0])}"
+        return f"INSERT INTO {target} ({col_list}) SELECT {source_list} FROM {stage} AS s ON DUPLICATE KEY UPDATE {update}"
+    # PostgreSQL and SQLite; WHERE true keeps SQLite from reading ON CONFLICT as a join clause
+    action = f"DO UPDATE SET {', '.join(f'{q(c)} = excluded.{q(c)}' for c in others)}" if others else "DO NOTHING"
+    return f"INSERT INTO {target} ({col_list}) SELECT {source_list} FROM {stage} AS s WHERE true ON CONFLICT ({', '.join(q(k) for k in keys)}) {action}"
+
+def apply_staged(conn, tbl, data_ready):
+    # Stage, apply and drop inside the caller's transaction; returns the apply statement's rowcount
+    mode, plan, keys = table_write_mode(tbl), get_plan(tbl), unique_key(tbl)
+    cols = plan['write']
+    missing = [k for k in keys if k not in cols]
+    if missing:
+        raise RuntimeError(f"{tbl['destinationTable']} has no key column(s) {', '.join(missing)} to {mode} on")
+    preparer = conn.dialect.identifier_preparer
+    target = preparer.format_table(dest_table(tbl, cols))
+    stage, create, drop = stage_statements(target, ', '.join(preparer.quote(c) for c in cols))
+    conn.execute(text(drop))
+    conn.execute(text(create))
+    get_writer()(conn, table(stage, *[column(c) for c in cols]), cols, project(data_ready, plan['write_idx']))
+    affected = conn.execute(text(apply_statement(mode, preparer.quote, target, stage, keys, cols))).rowcount
+    conn.execute(text(drop))
+    return affected
+
+def write_staged(tbl, data_ready):
+    # One transaction per commit chunk
+    started = time.time()
+    mode = table_write_mode(tbl)
+    with engine_dest.begin() as conn:
+        affected = apply_staged(conn, tbl, data_ready)
+    elapsed = time.time() - started
+    if mode == 'update' and affected >= 0 and affected != len(data_ready):
+        log("WARNING", f"{tbl['destinationTable']}: {len(data_ready)} rows staged but {affected} updated")
+    observe('bdt_insert_seconds', elapsed, table=tbl['destinationTable'])
+    inc('bdt_rows_written_total', len(data_ready), table=tbl['destinationTable'])
+    verb = "Updated" if mode == 'update' else "Upserted"
+    log("INFO", f"{verb} {len(data_ready)} rows {'of' if mode == 'update' else 'into'} {tbl['destinationTable']} in {elapsed:.2f}s ({len(data_ready) / max(elapsed, 1e-6):.0f} rows/s)")
+
+def commit_chunk(tbl, data_ready, last_key):
+    # last_key is the source key of the chunk's last row, taken before tokenization
+    (insert_rows if table_write_mode(tbl) == 'insert' else write_staged)(tbl, data_ready)
+    save_checkpoint(tbl, last_key)
+
+# === Pipeline ===
+async def run_pipeline(client, limiter, tbl, stats, bounds=(None, None)):
+    # reader -> tokenizer workers -> writer, connected by bounded queues. A full queue blocks the stage
+    # feeding it, so a slow destination throttles reads instead of piling chunks up in memory.
+    loop = asyncio.get_event_loop()
+    read_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+
+    async def reader():
+        chunks = fetch_replay_chunks(tbl) if args.replay else fetch_chunks(tbl, bounds)
+        seq = 0
+        while True:
+            rows = await loop.run_in_executor(None, next, chunks, None)
+            if rows is None:
+                break
+            await read_queue.put((seq, stats['read'], rows))
+            stats['read'] += len(rows)
+            seq += 1
+        for _ in range(tokenizer_workers):
+            await read_queue.put(None)
+
+    async def tokenizer():
+        while True:
+            item = await read_queue.get()
+            if item is None:
+                break
+            seq, offset, rows = item
+            results = await process_chunk(client, limiter, tbl, offset, rows)
+            await write_queue.put((seq, rows, results))
+        await write_queue.put(None)
+
+    async def writer():
+        # Chunks are committed in key order (tokenizers may finish out of order) so every
+        # checkpoint covers all rows before it
+        pending, ready, next_seq = [], {}, 0
+
+        async def flush(batch):
+            # batch holds (row, source key) pairs
+            await loop.run_in_executor(None, commit_chunk, tbl, [row for row, _ in batch], batch[-1][1])
+            stats['written'] += len(batch)
+            if cache_store is not None:
+                cache_store.commit()
+
+        finished = 0
+        while finished < tokenizer_workers:
+            item = await write_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            ready[item[0]] = item[1:]
+            while next_seq in ready:
+                rows, results = ready.pop(next_seq)
+                next_seq += 1
+                data_ready = [(r, key) for _, r, key in results if r]
+                stats['failed'] += len(rows) - len(data_ready)
+                pending.extend(data_ready)
+                while len(pending) >= commit_size:
+                    await flush(pending[:commit_size])
+                    pending = pending[commit_size:]
+        if pending:
+            await flush(pending)
+
+    tasks = [asyncio.ensure_future(t) for t in (reader(), writer(), *(tokenizer() for _ in range(tokenizer_workers)))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        raise
+
+# === Table Scheduler ===
+def estimate_rows(tbl):
+    # Cheap catalog estimates where the dialect keeps them, COUNT(*) otherwise
+    schema, name = tbl['sourceSchema'] or None, tbl['sourceTable']
+    qualified = f"{schema}.{name}" if schema else name
+    with engine_src.connect() as conn:
+        estimate = None
+        if src_backend == 'postgresql':
+            estimate = conn.execute(text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"), {"name": qualified}).scalar()
+        elif src_backend == 'mssql':
+            estimate = conn.execute(text("SELECT SUM(rows) FROM sys.partitions WHERE object_id = OBJECT_ID(:name) AND index_id IN (0, 1)"), {"name": qualified}).scalar()
+        elif src_backend in ('mysql', 'mariadb'):
+            estimate = conn.execute(text("SELECT table_rows FROM information_schema.tables WHERE table_schema = COALESCE(:schema, DATABASE()) AND table_name = :name"), {"schema": schema, "name": name}).scalar()
+        if estimate is None or estimate < 0:
+            estimate = conn.execute(select(func.count()).select_from(table(name, schema=schema))).scalar()
+        return int(estimate)
+
+async def run_table(client, limiter, tbl, stats, bounds=(None, None)):
+    started = time.time()
+    try:
+        await run_pipeline(client, limiter, tbl, stats, bounds)
+        await asyncio.get_event_loop().run_in_executor(None, save_checkpoint, tbl, None, True)
+        if stats['read'] == 0:
+            log("INFO", f"{tbl['sourceTable']}: no rows to process")
+    except SQLAlchemyError as e:
+        stats['error'] = str(e)
+        log("ERROR", f"{tbl['sourceTable']}: DB Error: {e}")
     except Exception as e:
-        import traceback
-        log("ERROR", f"Row {idx} unexpected error: {str(e)}")
-        traceback.print_exc()
-        return (idx, None)
+        stats['error'] = str(e)
+        log("ERROR", f"{tbl['sourceTable']}: Unexpected Error: {e}")
+    finally:
+        log("INFO", f"{tbl['sourceTable']} -> {tbl['destinationTable']}: {stats['written']} rows written, {stats['failed']} failed in {round(time.time() - started)}s", summary=True)
+
+async def run_tables(client, all_stats, sizes, all_bounds=None):
+    # Every table shares one VTS client, one adaptive request limit and the engines' DB pools.
+    # Largest tables start first so a big straggler does not start last and set the total runtime.
+    limiter = AdaptiveLimiter(vts_floor, vts_budget, vts_initial)
+    checker = asyncio.ensure_future(health_checks(client)) if len(vts_nodes) > 1 else None
+    table_slots = asyncio.Semaphore(table_concurrency)
+    all_bounds = all_bounds or [(None, None)] * len(tables)
+    order = sorted(range(len(tables)), key=lambda i: sizes[i], reverse=True)
+
+    async def slot(tbl, stats, bounds):
+        if bounds is None:
+            return
+        async with table_slots:
+            await run_table(client, limiter, tbl, stats, bounds)
+
+    try:
+        await asyncio.gather(*(slot(tables[i], all_stats[i], all_bounds[i]) for i in order))
+    finally:
+        if checker:
+            checker.cancel()
+    log("INFO", f"VTS concurrency settled at {int(limiter.limit)}")
+    set_gauge('bdt_vts_concurrency_limit', int(limiter.limit), **shard_labels())
+
+# === Sharded Execution ===
+def shard_worker(shard, all_bounds, sizes, progress):
+    # Runs in its own process with its own engines, VTS client and a 1/threadCount share of maxConnections
+    global vts_budget, vts_floor, vts_initial, shard_label, shard_index
+    vts_budget = max(1, -(-vts_budget // shard_count))
+    vts_floor = max(1, vts_floor // shard_count)
+    vts_initial = max(1, vts_initial // shard_count)
+    shard_label = f" Shard {shard}"
+    shard_index = shard
+    all_stats = [{'read': 0, 'written': 0, 'failed': 0} for _ in tables]
+
+    async def report():
+        while True:
+            progress.put((shard, [dict(st) for st in all_stats], dict(cache_stats), None))
+            await asyncio.sleep(1)
+
+    async def run():
+        open_cache_store()
+        reporter = asyncio.ensure_future(report())
+        try:
+            async with make_vts_client() as client:
+                await run_tables(client, all_stats, sizes, [b[shard] for b in all_bounds])
+        finally:
+            reporter.cancel()
+            close_cache_store()
+
+    try:
+        asyncio.run(run())
+    finally:
+        progress.put((shard, all_stats, dict(cache_stats), metrics_snapshot()))
+
+def run_sharded(sizes, all_bounds, all_stats):
+    # Coordinator: run one worker process per key range of every table,
+    # and merge the workers' progress and failure counts as they report in.
+    ctx = multiprocessing.get_context('spawn')
+    progress = ctx.Queue()
+    workers = [ctx.Process(target=shard_worker, args=(k, all_bounds, sizes, progress)) for k in range(shard_count)]
+    for w in workers:
+        w.start()
+    log("INFO", f"Started {shard_count} shard workers")
+
+    latest, done, last_log, shard_metrics = {}, set(), time.time(), []
+
+    def merge():
+        for i, stats in enumerate(all_stats):
+            for key in ('read', 'written', 'failed'):
+                stats[key] = sum(snap[0][i][key] for snap in latest.values())
+            errors = [snap[0][i]['error'] for snap in latest.values() if 'error' in snap[0][i]]
+            if errors:
+                stats['error'] = errors[0]
+        for key in ('hits', 'misses'):
+            cache_stats[key] = sum(snap[1][key] for snap in latest.values())
+
+    while len(done) < shard_count:
+        try:
+            shard, snapshot, cache_snapshot, final_metrics = progress.get(timeout=1)
+            latest[shard] = (snapshot, cache_snapshot)
+            if final_metrics is not None:
+                shard_metrics.append(final_metrics)
+                done.add(shard)
+        except queue.Empty:
+            for k, w in enumerate(workers):
+                if not w.is_alive() and k not in done:
+                    log("ERROR", f"Shard worker {k} exited with code {w.exitcode}")
+                    done.add(k)
+        if time.time() - last_log >= 5:
+            merge()
+            last_log = time.time()
+            log("INFO", f"Progress: {sum(st['read'] for st in all_stats)} read, {sum(st['written'] for st in all_stats)} written, {sum(st['failed'] for st in all_stats)} failed")
+
+    for w in workers:
+        w.join()
+    merge()
+    merge_metrics(shard_metrics)
+
+# === Pre-flight Plan ===
+# --plan reads the first --plan-sample rows of each table (in whole chunks), tokenizes them,
+# measures VTS at a few concurrency levels with the sample's bulks, and writes the sample to the
+# destination inside a transaction that is rolled back. The pipeline overlaps reading, tokenizing and writing, so a table runs at the
+# pace of its slowest stage: projected runtime = rows / min(read, VTS, write rows/s), with the DB
+# stages scaling with threadCount and VTS throughput shared by all shards.
+PLAN_LEVELS = (1, 4, 16, 64)
+PLAN_ROUNDS = 2
+
+def source_widths(tbl, rows):
+    # Declared type and sampled average/maximum text length of each planned column
+    plan = get_plan(tbl)
+    declared = {c['name']: c['type'] for c in inspect(engine_src).get_columns(tbl['sourceTable'], schema=tbl['sourceSchema'] or None)}
+    widths = []
+    for i, name in enumerate(plan['columns']):
+        lengths = [len(str(row[i])) for row in rows if row[i] is not None]
+        widths.append((name, declared.get(name), sum(lengths) / len(lengths) if lengths else 0, max(lengths, default=0)))
+    return widths
+
+def sample_write(tbl, rows):
+    # Times one write of the sample the way the run would do it, then rolls it back
+    if destination_columns(tbl) is None:
+        return None
+    plan = get_plan(tbl)
+    started = time.time()
+    with engine_dest.connect() as conn:
+        conn.begin()
+        try:
+            if table_write_mode(tbl) == 'insert':
+                get_writer()(conn, dest_table(tbl, plan['write']), plan['write'], project(rows, plan['write_idx']))
+            else:
+                apply_staged(conn, tbl, rows)
+        finally:
+            conn.rollback()
+    return time.time() - started
+
+async def measure_vts(client, bulks, level):
+    # PLAN_ROUNDS requests per slot at a fixed concurrency, without retries or the adaptive limit
+    slots = asyncio.Semaphore(level)
+    latencies, sent, errors = [], 0, 0
+
+    async def one(bulk):
+        nonlocal sent, errors
+        action, group, template, _, values = bulk
+        async with slots:
+            node = pick_node()
+            started = time.monotonic()
+            ok = False
+            try:
+                res = await client.post(node.url(action), content=encode_bulk(action, group, template, values), headers=headers)
+                ok = res.status_code == 200
+            except httpx.HTTPError:
+                pass
+            except asyncio.CancelledError:
+                ok = None
+                raise
+            finally:
+                latency = time.monotonic() - started
+                node_done(node, latency, ok)
+            latencies.append(latency)
+            if ok:
+                sent += len(values)
+            else:
+                errors += 1
+
+    # One unmeasured request per slot first, so connection setup is not counted
+    await asyncio.gather(*(one(bulks[n % len(bulks)]) for n in range(level)))
+    latencies, sent, errors = [], 0, 0
+    started = time.monotonic()
+    await asyncio.gather(*(one(bulks[n % len(bulks)]) for n in range(level * PLAN_ROUNDS)))
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {'level': level, 'p50': latencies[len(latencies) // 2], 'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'values_per_s': sent / elapsed if elapsed else 0.0, 'errors': errors}
+
+def plan_recommendation(est):
+    # Concurrency: the lowest level within 10% of the best measured throughput. Batch: enough rows
+    # for that many full bulks per chunk, within 1000..100000 and ~512 MB of chunks in flight.
+    # Shards: enough parallel readers/writers to keep up with VTS, at most one per CPU.
+    levels = [m for e in est for m in e['vts']]
+    best = max((m['values_per_s'] for m in levels), default=0)
+    concurrency = min((m['level'] for m in levels if m['values_per_s'] >= 0.9 * best), default=vts_initial)
+    values_per_row = max((e['values_per_row'] for e in est), default=0) or 1
+    row_bytes = max((e['row_bytes'] for e in est), default=100) or 100
+    batch = int(-(-bulk_size * concurrency // values_per_row))
+    batch = min(batch, (512 << 20) // (row_bytes * (queue_size + tokenizer_workers + 2)))
+    batch = max(1000, min(100000, -(-batch // 1000) * 1000))
+    shards = 1
+    for e in est:
+        db_rate = min(r for r in (e['read_rps'], e['write_rps']) if r) if (e['read_rps'] or e['write_rps']) else 0
+        if db_rate and e['vts_rps']:
+            shards = max(shards, -(-int(e['vts_rps']) // int(db_rate)))
+    return {'batchSize': batch, 'initialConcurrency': max(1, concurrency // len(vts_nodes)),
+            'maxConnections': max(1, 2 * concurrency // len(vts_nodes)), 'threadCount': min(shards, os.cpu_count() or 1)}
+
+def projected_seconds(e, shards, vts_rps):
+    rates = [r * shards for r in (e['read_rps'], e['write_rps']) if r]
+    if vts_rps:
+        rates.append(vts_rps)
+    return e['rows'] / min(rates) if rates and e['rows'] else 0.0
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 60:.1f}min" if seconds >= 60 else f"{seconds:.1f}s"
+
+async def plan_run():
+    loop = asyncio.get_event_loop()
+    est = []
+    async with make_vts_client() as client:
+        limiter = AdaptiveLimiter(vts_floor, vts_budget, vts_initial)
+        for tbl in tables:
+            name = f"{tbl['sourceTable']} -> {tbl['destinationTable']}"
+            rows = await loop.run_in_executor(None, estimate_rows, tbl)
+            started = time.monotonic()
+            chunks, chunk = fetch_chunks(tbl), []
+            while len(chunk) < args.plan_sample:
+                more = await loop.run_in_executor(None, next, chunks, [])
+                if not more:
+                    break
+                chunk.extend(more)
+            read_seconds = time.monotonic() - started
+            chunks.close()
+            if not chunk:
+                log("INFO", f"{name}: source is empty, nothing to plan", summary=True)
+                continue
+            sample = chunk[:args.plan_sample]
+            widths = await loop.run_in_executor(None, source_widths, tbl, sample)
+            row_bytes = int(sum(avg for _, _, avg, _ in widths)) + 8 * len(widths)
+
+            # Bulks are built from a copy before the sample is tokenized, so the cache cannot hide them
+            bulks = list(build_bulk_requests(tbl, [list(r) for r in sample], {}))
+            values_per_row = sum(len(b[4]) for b in bulks) / len(sample)
+            remote = [b for b in bulks if b[2] not in fpe_templates]
+            local = [b for b in bulks if b[2] in fpe_templates]
+            levels = []
+            for level in sorted({n for n in PLAN_LEVELS if n < vts_budget} | {vts_budget}) if remote else []:
+                levels.append(await measure_vts(client, remote, level))
+            local_rate = None
+            if local:
+                started = time.monotonic()
+                for action, group, template, _, values in local:
+                    await loop.run_in_executor(None, fpe_bulk, action, group, template, values)
+                local_rate = sum(len(b[4]) for b in local) / max(time.monotonic() - started, 1e-6)
+
+            tokenized = await process_chunk(client, limiter, tbl, 0, sample, record=False)
+            ready = [row for _, row, _ in tokenized if row is not None]
+            write_seconds, write_note = None, "no rows to write"
+            try:
+                if ready:
+                    write_seconds = await loop.run_in_executor(None, sample_write, tbl, ready)
+                    write_note = "no destination table yet"
+            except SQLAlchemyError as e:
+                log("WARNING", f"{name}: sample write failed: {e}", summary=True)
+                write_note = "sample write failed"
+            vts_values = max((m['values_per_s'] for m in levels), default=0)
+            if local_rate:
+                vts_values = local_rate if not vts_values else 1 / (1 / vts_values + 1 / local_rate)
+            est.append({'table': name, 'rows': rows, 'values_per_row': values_per_row, 'row_bytes': row_bytes, 'vts': levels,
+                        'read_rps': len(chunk) / read_seconds if read_seconds else 0.0,
+                        'write_rps': len(ready) / write_seconds if write_seconds else 0.0,
+                        'vts_rps': vts_values / values_per_row if vts_values and values_per_row else 0.0})
+
+            e = est[-1]
+            log("INFO", f"{name}: ~{rows} rows, {values_per_row:.2f} values/row, ~{row_bytes} B/row", summary=True)
+            for col, declared, avg, longest in widths:
+                log("INFO", f"  {col}: {declared}, sampled length avg {avg:.1f} max {longest}", summary=True)
+            log("INFO", f"  read {e['read_rps']:.0f} rows/s ({len(chunk)} rows), write "
+                        + (f"{e['write_rps']:.0f} rows/s ({len(ready)} rows, rolled back)" if write_seconds else f"not measured ({write_note})"), summary=True)
+            for m in levels:
+                log("INFO", f"  VTS concurrency {m['level']}: p50 {m['p50'] * 1000:.0f}ms, p95 {m['p95'] * 1000:.0f}ms, {m['values_per_s']:.0f} values/s"
+                            + (f", {m['errors']} failed requests" if m['errors'] else ""), summary=True)
+            if local_rate:
+                log("INFO", f"  local FPE: {local_rate:.0f} values/s", summary=True)
+            log("INFO", f"  sample tokenize: {len(sample)} rows, {len(sample) - len(ready)} failed", summary=True)
+
+    if not est:
+        return
+    rec = plan_recommendation(est)
+    current_levels = [max((m for m in e['vts'] if m['level'] <= vts_budget), key=lambda m: m['level'], default=None) for e in est]
+    current = sum(projected_seconds(e, shard_count, (m['values_per_s'] / e['values_per_row']) if m and e['values_per_row'] else e['vts_rps'])
+                  for e, m in zip(est, current_levels))
+    recommended = sum(projected_seconds(e, rec['threadCount'], e['vts_rps']) for e in est)
+    for e in est:
+        stages = {'read': e['read_rps'] * rec['threadCount'], 'VTS': e['vts_rps'], 'write': e['write_rps'] * rec['threadCount']}
+        bottleneck = min((k for k, v in stages.items() if v), key=lambda k: stages[k], default='none')
+        log("INFO", f"{e['table']}: bottleneck {bottleneck}, ~{format_duration(projected_seconds(e, rec['threadCount'], e['vts_rps']))}", summary=True)
+    log("INFO", f"Projected runtime: ~{format_duration(current)} with the current settings (threadCount {shard_count}, maxConnections {vts.get('maxConnections', 100)}), "
+                f"~{format_duration(recommended)} with the recommended ones", summary=True)
+    log("SUCCESS", f"Recommended: batchSize {rec['batchSize']}, commitSize {rec['batchSize']}, threadCount {rec['threadCount']}, "
+                   f"vts.initialConcurrency {rec['initialConcurrency']}, vts.maxConnections {rec['maxConnections']}", summary=True)
 
 # === Main Execution ===
 async def main():
     start = time.time()
-    total = 0
-    error = 0
+    all_stats = [{'read': 0, 'written': 0, 'failed': 0} for _ in tables]
     try:
         # Run blocking DB connection check in thread pool
         def test_connections():
@@ -135,43 +2035,43 @@ async def main():
                 src_conn.execute(text("SELECT 1"))
                 dst_conn.execute(text("SELECT 1"))
 
-        await asyncio.get_event_loop().run_in_executor(None, test_connections)
-
-        # Fetch source data
-        def fetch_rows():
-            with engine_src.connect() as conn:
-                log("INFO", "Fetching data")
-                return list(conn.execute(text(f"SELECT * FROM {schema_src}.{table_src} ORDER BY created_at ASC")).mappings())
-        
-        rows = await asyncio.get_event_loop().run_in_executor(None, fetch_rows)
-        if not rows:
-            log("INFO", "No rows to process")
-            return
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, test_connections)
+
+        if args.replay:
+            # Only tables with bad records run, in one process, without checkpoints
+            keys, replay_files = await loop.run_in_executor(None, load_bad_records)
+            replay_keys.update(keys)
+            sizes = [len(replay_keys.get(table_id(tbl), [])) for tbl in tables]
+            all_bounds = [[(None, None)] if n else [None] for n in sizes]
+        else:
+            sizes = []
+            for tbl in tables:
+                await loop.run_in_executor(None, create_destination, tbl)
+                if table_write_mode(tbl) == 'upsert':
+                    await loop.run_in_executor(None, build_destination_indexes, tbl, True)
+                sizes.append(await loop.run_in_executor(None, estimate_rows, tbl))
+            all_bounds = []
+            for tbl, size in zip(tables, sizes):
+                all_bounds.append(await loop.run_in_executor(None, plan_ranges, tbl, size))
+        log("INFO", f"Scheduling {len(tables)} table(s): " + ", ".join(f"{t['sourceTable']} (~{n} rows)" for t, n in sorted(zip(tables, sizes), key=lambda x: -x[1])))
+
+        if shard_count > 1 and not args.replay:
+            await loop.run_in_executor(None, run_sharded, sizes, all_bounds, all_stats)
+        else:
+            # Stream every table through its own pipeline, sharing the VTS client and DB pools
+            open_cache_store()
+            async with make_vts_client() as client:
+                await run_tables(client, all_stats, sizes, [b[0] for b in all_bounds])
 
-        # Process rows concurrently using asyncio.gather
-        semaphore = asyncio.Semaphore(100)
-        async def limited_process_row(i, r):
-            async with semaphore:
-                return await process_row(i, r)
-        tasks = [limited_process_row(i, dict(r)) for i, r in enumerate(rows)]
-        results = await asyncio.gather(*tasks)
-
-        # Insert to destination
-        success_indexes = [i for i, r in results if r]
-        error = set(range(len(rows))) - set(success_indexes)
-
-        data_ready = [r for i, r in results if r]
-        if data_ready:
-            def insert_rows():
-                with engine_dest.connect() as conn:
-                    cols = list(data_ready[0].keys())
-                    insert_sql = text(f"INSERT INTO {schema_dest}.{table_dest} ({', '.join(cols)}) VALUES ({', '.join([f':{c}' for c in cols])})")
-                    conn.execute(insert_sql, data_ready)
-                    conn.commit()
-
-            await asyncio.get_event_loop().run_in_executor(None, insert_rows)
-            total = len(data_ready)
-            error = len(error)
+        for tbl, stats in zip(tables, all_stats):
+            if 'error' not in stats and not args.replay:
+                if await loop.run_in_executor(None, finish_table, tbl, stats['failed']):
+                    await loop.run_in_executor(None, build_destination_indexes, tbl)
+        if args.replay and not any('error' in stats for stats in all_stats):
+            # Rows that failed again are already in the fresh bad record file
+            for path in replay_files:
+                os.remove(path)
 
     except KeyboardInterrupt:
         log("INFO", "Interrupted by user")
@@ -180,11 +2080,20 @@ async def main():
     except Exception as e:
         log("ERROR", f"Unexpected Error: {e}")
     finally:
+        close_cache_store()
+        write_reports(start, all_stats)
+        if cache_stats['hits'] or cache_stats['misses']:
+            log("INFO", f"Token cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses", summary=True)
+        total = sum(st['written'] for st in all_stats)
+        error = sum(st['failed'] for st in all_stats)
+        failed_tables = sum(1 for st in all_stats if 'error' in st)
+        if bad_record_path and error:
+            log("INFO", f"{error} failed row(s) recorded in {bad_record_path}; rerun with --replay to retry them", summary=True)
         if total > 0:
-            log("SUCCESS", f"Completed. Processed {total} rows in {round(time.time() - start)}s with {error} missing rows")
+            log("SUCCESS", f"Completed {len(tables) - failed_tables}/{len(tables)} table(s). Processed {total} rows in {round(time.time() - start)}s with {error} missing rows", summary=True)
         else:
-            log("WARNING", f"No rows processed successfully. Took {round(time.time() - start)}s")
+            log("WARNING", f"No rows processed successfully. Took {round(time.time() - start)}s", summary=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(plan_run() if args.plan else main())
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, MetaData, Table, Column, String, DateTime, text
+from sqlalchemy.engine import make_url
+
+# === Helper Functions ===
+def get_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def log(level, message):
+    print(f"[{level}] {get_timestamp()} - {message}", flush=True)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# bdt.py reads DbToDbTransformation01.policy and bdt.config from the working directory and refuses
+# tables larger than batchSize, so every run gets its own directory with both files written into it.
+MODES = {
+    "bdt": "bdt.py",
+    "v2": "bdt_v2.py",
+    "v3": "bdt_v3.py",
+    "v4": "bdt_v4.py",
+}
+
+# === Argument Parsing ===
+parser = argparse.ArgumentParser(description="End-to-end benchmark of the BDT scripts against the bundled mock VTS")
+parser.add_argument("--modes", default="bdt,v2,v3,v4", help=f"Comma-separated modes to run ({', '.join(MODES)}; v4xN runs bdt_v4.py with threadCount N)")
+parser.add_argument("--sizes", default="1000,10000", help="Comma-separated dataset row counts")
+parser.add_argument("--db-url", default="", help="SQLAlchemy URL for the datasets (default: SQLite files in the work directory)")
+parser.add_argument("--schema", default="", help="Schema holding the benchmark tables (default: main for SQLite, public otherwise)")
+parser.add_argument("--workdir", default="", help="Directory for datasets, configs and logs (default: a temporary directory)")
+parser.add_argument("--keep", action="store_true", help="Keep the work directory after the run")
+parser.add_argument("--timeout", type=float, default=1800, help="Seconds before a single run is killed")
+parser.add_argument("--seed", type=int, default=42, help="Random seed for the generated datasets")
+parser.add_argument("--latency", type=float, default=5.0, help="Mock VTS base latency per request in ms")
+parser.add_argument("--jitter", type=float, default=2.0, help="Mock VTS random extra latency per request in ms")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Mock VTS fraction of requests failed with HTTP 500")
+parser.add_argument("--max-concurrent", type=int, default=0, help="Mock VTS in-flight limit before answering 429 (0: unlimited)")
+parser.add_argument("--config", default="", help="Extra bdt config JSON merged into every generated config (e.g. tuning keys)")
+parser.add_argument("--output", default="", help="Write the results as JSON to this file")
+parser.add_argument("--baseline", default="", help="Results JSON from an earlier run; exit 1 if throughput drops more than --tolerance")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop against --baseline (fraction)")
+
+# === Dataset ===
+POLICY_COLUMNS = [
+    {"name": "email", "action": "TOKENIZE", "config": [{"tokenGroup": "bench", "tokenTemplate": "email"}]},
+    {"name": "phone", "action": "TOKENIZE", "config": [{"tokenGroup": "bench", "tokenTemplate": "phone"}]},
+    {"name": "ktp", "action": "TOKENIZE", "config": [{"tokenGroup": "bench", "tokenTemplate": "ktp"}]},
+]
+
+def bench_table(metadata, name, schema):
+    # created_at is the ordering column of bdt_v2/v3/v4, create_date the one bdt.py sorts on. Both are
+    # NOT NULL so bdt_v4 pages by its default (created_at, id) key instead of falling back to id alone
+    return Table(
+        name, metadata,
+        Column("id", String(36), primary_key=True),
+        Column("full_name", String(100)),
+        Column("email", String(100)),
+        Column("phone", String(20)),
+        Column("ktp", String(16)),
+        Column("created_at", DateTime, nullable=False),
+        Column("create_date", DateTime, nullable=False),
+        schema=schema,
+    )
+
+def generate_rows(size, seed):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for i in range(size):
+        stamp = start + timedelta(seconds=i)
+        # Emails repeat so the token cache and bulk de-duplication have something to find
+        yield {
+            "id": f"{i:012d}-{rng.getrandbits(64):016x}",
+            "full_name": f"User {rng.randrange(10**6)}",
+            "email": f"user{rng.randrange(max(1, size // 4))}@example.com",
+            "phone": f"08{rng.randrange(10**10):010d}",
+            "ktp": f"{rng.randrange(10**16):016d}",
+            "created_at": stamp,
+            "create_date": stamp,
+        }
+
+def build_dataset(source_url, dest_url, schema, size, seed, source_name, dest_name):
+    metadata = MetaData()
+    schema = None if schema == "main" else schema
+    dest_engine = create_engine(dest_url)
+    dest = bench_table(metadata, dest_name, schema)
+    dest.drop(dest_engine, checkfirst=True)
+    dest.create(dest_engine)
+    dest_engine.dispose()
+
+    engine = create_engine(source_url)
+    source = bench_table(metadata, source_name, schema)
+    source.drop(engine, checkfirst=True)
+    source.create(engine)
+    batch = []
+    with engine.begin() as conn:
+        for row in generate_rows(size, seed):
+            batch.append(row)
+            if len(batch) >= 10000:
+                conn.execute(source.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(source.insert(), batch)
+    engine.dispose()
+
+def count_rows(url, schema, name):
+    engine = create_engine(url)
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text(f"SELECT COUNT(*) FROM {schema}.{name}")).scalar()
+    finally:
+        engine.dispose()
+
+def clear_table(url, schema, name):
+    engine = create_engine(url)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {schema}.{name}"))
+    finally:
+        engine.dispose()
+
+# === Mock VTS ===
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def mock_call(port, method, path):
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(req, timeout=10) as res:
+        return json.loads(res.read())
+
+def start_mock(opts, port, log_path):
+    cmd = [
+        sys.executable, os.path.join(HERE, "mock_vts.py"), "--port", str(port), "--user", "bench", "--password", "bench",
+        "--latency", str(opts.latency), "--jitter", str(opts.jitter), "--error-rate", str(opts.error_rate),
+        "--max-concurrent", str(opts.max_concurrent), "--seed", str(opts.seed),
+    ]
+    proc = subprocess.Popen(cmd, stdout=open(log_path, "w"), stderr=subprocess.STDOUT)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            mock_call(port, "GET", "/stats")
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"Mock VTS did not start, see {log_path}")
+
+# === Runs ===
+def write_run_files(run_dir, opts, source_url, dest_url, schema, port, shards, batch_size, source_name, dest_name):
+    os.makedirs(run_dir, exist_ok=True)
+    policy = {
+        "id": "benchmark",
+        "name": "benchmark",
+        "source": {"connectionurl": source_url},
+        "destination": {"connectionurl": dest_url},
+        "tables": [{
+            "sourceSchema": schema, "destinationSchema": schema,
+            "sourceTable": source_name, "destinationTable": dest_name,
+            "columns": POLICY_COLUMNS,
+        }],
+    }
+    config = {
+        "threadCount": shards,
+        "batchSize": batch_size,
+        "vts": {
+            "hostName": "127.0.0.1", "userName": "bench", "password": "bench",
+            "tokenUrl": f"http://127.0.0.1:{port}/vts/tokenize",
+            "detokenUrl": f"http://127.0.0.1:{port}/vts/detokenize",
+            "sslConfig": {"serverConfig": {}, "clientConfig": {}},
+        },
+        "crypto": {},
+        "characterSets": {},
+        "stateFile": os.path.join(run_dir, "bdt_state.db"),
+        "reportFile": os.path.join(run_dir, "report.json"),
+        "logLevel": "INFO",
+    }
+    if opts.config:
+        with open(opts.config, "r", encoding="utf-8") as f:
+            extra = json.load(f)
+        extra_vts = extra.pop("vts", {})
+        config.update(extra)
+        config["vts"].update(extra_vts)
+    for name, data in (("DbToDbTransformation01.policy", policy), ("bdt.config", config)):
+        with open(os.path.join(run_dir, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+def run_mode(mode, opts, source_url, dest_url, schema, size, port, workdir, source_name, dest_name):
+    base, _, shards = mode.partition("x")
+    run_dir = os.path.join(workdir, f"{mode}-{size}")
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    batch_size = max(size, 1) if base == "bdt" else 1000
+    write_run_files(run_dir, opts, source_url, dest_url, schema, port, int(shards or 1), batch_size, source_name, dest_name)
+    clear_table(dest_url, schema, dest_name)
+    mock_call(port, "POST", "/reset")
+
+    cmd = [sys.executable, os.path.join(HERE, MODES[base])]
+    if base != "bdt":
+        cmd += ["-p", "DbToDbTransformation01.policy", "-c", "bdt.config"]
+    log_path = os.path.join(run_dir, "run.log")
+    started = time.perf_counter()
+    with open(log_path, "w") as out:
+        proc = subprocess.Popen(cmd, cwd=run_dir, stdout=out, stderr=subprocess.STDOUT)
+        timed_out = False
+        while True:
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.perf_counter() - started > opts.timeout:
+                proc.kill()
+                timed_out = True
+            time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    stats = mock_call(port, "GET", "/stats")
+    written = count_rows(dest_url, schema, dest_name)
+    return {
+        "mode": mode,
+        "size": size,
+        "exitCode": os.waitstatus_to_exitcode(status),
+        "timedOut": timed_out,
+        "rowsWritten": written,
+        "seconds": round(elapsed, 3),
+        "rowsPerSecond": round(written / elapsed, 1) if elapsed else None,
+        "vtsRequests": stats["requests"],
+        "vtsItems": stats["items"],
+        "vtsP99Ms": stats["latencyMs"]["p99"],
+        "vtsMaxInFlight": stats["maxInFlight"],
+        # ru_maxrss is KiB on Linux; wait4 reports the largest single process in the child's tree
+        "peakRssMb": round(usage.ru_maxrss / 1024, 1),
+        "log": log_path,
+    }
+
+# === Reporting ===
+def print_table(results):
+    header = ("mode", "rows", "written", "seconds", "rows/s", "VTS reqs", "VTS p99 ms", "peak RSS MB", "exit")
+    lines = [header]
+    for r in results:
+        lines.append((
+            r["mode"], str(r["size"]), str(r["rowsWritten"]), f"{r['seconds']:.2f}",
+            f"{r['rowsPerSecond']:.1f}" if r["rowsPerSecond"] is not None else "-",
+            str(r["vtsRequests"]), "-" if r["vtsP99Ms"] is None else f"{r['vtsP99Ms']:.1f}",
+            f"{r['peakRssMb']:.1f}", "timeout" if r["timedOut"] else str(r["exitCode"]),
+        ))
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    for n, line in enumerate(lines):
+        print("  ".join(cell.rjust(w) if i else cell.ljust(w) for i, (cell, w) in enumerate(zip(line, widths))))
+        if n == 0:
+            print("  ".join("-" * w for w in widths))
+
+def compare_baseline(results, path, tolerance):
+    with open(path, "r", encoding="utf-8") as f:
+        baseline = {(r["mode"], r["size"]): r for r in json.load(f)["results"]}
+    regressions = 0
+    for r in results:
+        old = baseline.get((r["mode"], r["size"]))
+        if not old or not old.get("rowsPerSecond") or r["rowsPerSecond"] is None:
+            continue
+        change = r["rowsPerSecond"] / old["rowsPerSecond"] - 1
+        level = "ERROR" if change < -tolerance else "INFO"
+        regressions += level == "ERROR"
+        log(level, f"{r['mode']} @ {r['size']} rows: {old['rowsPerSecond']} -> {r['rowsPerSecond']} rows/s ({change:+.1%})")
+    return regressions
+
+# === Main Execution ===
+def main():
+    opts = parser.parse_args()
+    modes = [m.strip() for m in opts.modes.split(",") if m.strip()]
+    for mode in modes:
+        if mode.partition("x")[0] not in MODES:
+            parser.error(f"unknown mode {mode}")
+    sizes = [int(s) for s in opts.sizes.split(",") if s.strip()]
+
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="bdt-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    port = free_port()
+    mock = start_mock(opts, port, os.path.join(workdir, "mock_vts.log"))
+    log("INFO", f"Mock VTS on port {port}, work directory {workdir}")
+
+    results = []
+    try:
+        for size in sizes:
+            # SQLite gets separate source and destination files so a streaming reader never blocks the writer
+            source_url = opts.db_url or f"sqlite:///{os.path.join(workdir, f'bench_{size}_src.db')}"
+            dest_url = opts.db_url or f"sqlite:///{os.path.join(workdir, f'bench_{size}_dst.db')}"
+            schema = opts.schema or ("main" if make_url(source_url).get_backend_name() == "sqlite" else "public")
+            source_name, dest_name = f"bench_src_{size}", f"bench_dst_{size}"
+            log("INFO", f"Building {size}-row dataset")
+            build_dataset(source_url, dest_url, schema, size, opts.seed, source_name, dest_name)
+            for mode in modes:
+                log("INFO", f"Running {mode} on {size} rows")
+                result = run_mode(mode, opts, source_url, dest_url, schema, size, port, workdir, source_name, dest_name)
+                level = "INFO" if result["exitCode"] == 0 and result["rowsWritten"] == size else "WARNING"
+                log(level, f"{mode}: {result['rowsWritten']}/{size} rows in {result['seconds']}s ({result['rowsPerSecond']} rows/s)")
+                results.append(result)
+    except KeyboardInterrupt:
+        log("INFO", "Interrupted by user")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    print()
+    print_table(results)
+    if opts.output:
+        with open(opts.output, "w", encoding="utf-8") as f:
+            json.dump({"created": get_timestamp(), "mock": {"latency": opts.latency, "jitter": opts.jitter,
+                       "errorRate": opts.error_rate, "maxConcurrent": opts.max_concurrent}, "results": results}, f, indent=2)
+        log("INFO", f"Results written to {opts.output}")
+
+    regressions = compare_baseline(results, opts.baseline, opts.tolerance) if opts.baseline else 0
+    if not opts.keep and not opts.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import io
+import os
+import re
+import time
+import random
+import argparse
+import multiprocessing
+from datetime import datetime, date, timedelta
+from faker import Faker
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, MetaData, Table, Column, String, DateTime, Date, text
+from sqlalchemy.engine import make_url
+
+load_dotenv()
+
+# === Helper Functions ===
+def get_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def log(level, message):
+    print(f"[{level}] {get_timestamp()} - {message}", flush=True)
+
+# === Argument Parsing ===
+parser = argparse.ArgumentParser(description="Generate dummy user rows for BDT load testing")
+parser.add_argument("--url", default=os.getenv("DATABASE_URL", ""), help="SQLAlchemy URL of the target database (default: DATABASE_URL from the environment/.env)")
+parser.add_argument("-n", "--rows", type=int, default=10000, help="Number of rows to generate")
+parser.add_argument("--seed", type=int, default=42, help="Random seed; the same seed and row count always give the same rows")
+parser.add_argument("--schema", choices=["users", "users_user"], default="users", help="Column set: users (PostgreSQL sample) or users_user (SQL Server sample)")
+parser.add_argument("--table", default="", help="Target table name (default: the --schema name)")
+parser.add_argument("--db-schema", default="", help="Database schema of the target table")
+parser.add_argument("--create", action="store_true", help="Create the table if it does not exist")
+parser.add_argument("--truncate", action="store_true", help="Delete existing rows before loading")
+parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes generating rows")
+parser.add_argument("--chunk-size", type=int, default=50000, help="Rows per generated and committed chunk")
+parser.add_argument("--start", default="2024-01-01 00:00:00", help="Timestamp of the first row; later rows are one second apart")
+
+# === Schemas ===
+SCHEMAS = {
+    "users": ("id", "full_name", "email", "phone", "ktp", "created_at"),
+    "users_user": ("id", "full_name", "email", "phone", "gender", "ktp", "npwp", "address",
+                   "city", "province", "birth_day", "birth_place", "nationality", "create_date"),
+}
+
+COLUMN_TYPES = {
+    "id": String(36), "full_name": String(100), "email": String(150), "phone": String(30), "gender": String(10),
+    "ktp": String(16), "npwp": String(16), "address": String(200), "city": String(100), "province": String(100),
+    "birth_day": Date, "birth_place": String(100), "nationality": String(50), "created_at": DateTime, "create_date": DateTime,
+}
+
+# The ordering columns are always filled; NOT NULL lets bdt_v4 page by its default (created_at, id) key
+NOT_NULL = {"id", "created_at", "create_date"}
+
+def target_table(schema_name, name, db_schema):
+    return Table(name, MetaData(), *[Column(c, COLUMN_TYPES[c], primary_key=(c == "id"), nullable=(c not in NOT_NULL))
+                                     for c in SCHEMAS[schema_name]], schema=db_schema or None)
+
+# === Row Generation ===
+# Faker is slow per call, so each worker builds the same seeded pools once and rows are assembled
+# from them with a per-chunk Random. Chunk k is always generated from (seed, k), which keeps the
+# dataset identical whatever the worker count.
+POOL_SIZE = 5000
+pools = None
+
+def build_pools(seed):
+    fake = Faker('id_ID')
+    fake.seed_instance(seed)
+    names = [fake.name() for _ in range(POOL_SIZE)]
+    return {
+        "names": names,
+        "slugs": [".".join(re.sub(r"[^a-z ]", "", n.lower()).split()[:2]) or "user" for n in names],
+        "domains": ["gmail.com", "yahoo.co.id", "outlook.com", "example.co.id", "mail.id"],
+        "addresses": [fake.street_address() for _ in range(POOL_SIZE)],
+        "cities": [fake.city() for _ in range(500)],
+        "provinces": [fake.state() for _ in range(50)],
+    }
+
+def init_worker(seed):
+    global pools
+    pools = build_pools(seed)
+
+def generate_chunk(job):
+    schema_name, seed, chunk_idx, first, count, start, fmt = job
+    rng = random.Random(seed * 1000003 + chunk_idx)
+    names, slugs, domains = pools["names"], pools["slugs"], pools["domains"]
+    addresses, cities, provinces = pools["addresses"], pools["cities"], pools["provinces"]
+    columns = SCHEMAS[schema_name]
+    rows = []
+    for n in range(first, first + count):
+        p = rng.randrange(POOL_SIZE)
+        values = {
+            "id": "%08x-%04x-4%03x-%04x-%012x" % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(12),
+                                                 0x8000 | rng.getrandbits(14), rng.getrandbits(48)),
+            "full_name": names[p],
+            "email": f"{slugs[p]}{n}@{domains[n % len(domains)]}",
+            "phone": f"08{rng.randrange(11, 99)}{rng.randrange(10**8):08d}",
+            "ktp": f"{rng.randrange(10**15, 10**16)}",
+            "created_at": start + timedelta(seconds=n),
+        }
+        if schema_name == "users_user":
+            values.update({
+                "gender": "Pria" if rng.getrandbits(1) else "Wanita",
+                "npwp": f"{rng.randrange(10**15, 10**16)}",
+                "address": addresses[rng.randrange(POOL_SIZE)],
+                "city": cities[rng.randrange(len(cities))],
+                "province": provinces[rng.randrange(len(provinces))],
+                "birth_day": date(1960, 1, 1) + timedelta(days=rng.randrange(47 * 365)),
+                "birth_place": cities[rng.randrange(len(cities))],
+                "nationality": "Indonesia",
+                "create_date": values["created_at"],
+            })
+        rows.append(tuple(values[c] for c in columns))
+    return count, (copy_text(rows) if fmt == "copy" else rows)
+
+def copy_text(rows):
+    out = io.StringIO()
+    for row in rows:
+        out.write("\t".join(str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r") for v in row))
+        out.write("\n")
+    return out.getvalue()
+
+# === Loaders ===
+# PostgreSQL gets COPY, everything else one executemany per chunk through the raw DB-API cursor:
+# pyodbc with fast_executemany sends parameter arrays, PyMySQL rewrites INSERT ... VALUES into
+# multi-row statements, and sqlite3 runs the prepared statement in a loop inside one transaction.
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s", "numeric": ":{n}", "named": ":c{n}"}
+
+def load_format(engine):
+    return "copy" if engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2" else "rows"
+
+def make_loader(engine, table_name, columns):
+    raw = engine.raw_connection()
+    cursor = raw.cursor()
+    if engine.dialect.name == "mssql":
+        cursor.fast_executemany = True
+    if engine.dialect.name == "sqlite":
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+    col_list = ", ".join(columns)
+
+    if load_format(engine) == "copy":
+        sql = f"COPY {table_name} ({col_list}) FROM STDIN"
+
+        def load(payload):
+            cursor.copy_expert(sql, io.StringIO(payload))
+            raw.commit()
+    else:
+        placeholder = PLACEHOLDERS[engine.dialect.paramstyle]
+        sql = f"INSERT INTO {table_name} ({col_list}) VALUES ({', '.join(placeholder.format(n=i + 1) for i in range(len(columns)))})"
+        named = engine.dialect.paramstyle == "named"
+
+        def load(payload):
+            cursor.executemany(sql, [{f"c{i + 1}": v for i, v in enumerate(row)} for row in payload] if named else payload)
+            raw.commit()
+
+    def close():
+        cursor.close()
+        raw.close()
+
+    return load, close
+
+# === Main Execution ===
+def main():
+    opts = parser.parse_args()
+    if not opts.url:
+        parser.error("--url or DATABASE_URL is required")
+    started = time.time()
+    engine = create_engine(opts.url)
+    table = target_table(opts.schema, opts.table or opts.schema, opts.db_schema)
+    table_name = f"{opts.db_schema}.{table.name}" if opts.db_schema else table.name
+    columns = SCHEMAS[opts.schema]
+
+    if opts.create:
+        table.create(engine, checkfirst=True)
+    if opts.truncate:
+        with engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {table_name}"))
+
+    fmt = load_format(engine)
+    start = datetime.strptime(opts.start, "%Y-%m-%d %H:%M:%S")
+    jobs = [(opts.schema, opts.seed, k, first, min(opts.chunk_size, opts.rows - first), start, fmt)
+            for k, first in enumerate(range(0, opts.rows, opts.chunk_size))]
+    workers = max(1, min(opts.workers, len(jobs)))
+    log("INFO", f"Generating {opts.rows} rows into {table_name} on {make_url(opts.url).get_backend_name()} "
+                f"({len(jobs)} chunks, {workers} workers, {'COPY' if fmt == 'copy' else 'executemany'})")
+
+    load, close = make_loader(engine, table_name, columns)
+    total, last_report = 0, time.time()
+    try:
+        # Workers generate ahead while this process loads chunks in order
+        with multiprocessing.get_context("spawn").Pool(workers, initializer=init_worker, initargs=(opts.seed,)) as pool:
+            for count, payload in pool.imap(generate_chunk, jobs):
+                load(payload)
+                total += count
+                if time.time() - last_report >= 5:
+                    last_report = time.time()
+                    log("INFO", f"Loaded {total}/{opts.rows} rows ({total / (time.time() - started):.0f} rows/s)")
+    except KeyboardInterrupt:
+        log("INFO", f"Interrupted by user after {total} rows")
+    finally:
+        close()
+        engine.dispose()
+
+    elapsed = time.time() - started
+    log("SUCCESS", f"Inserted {total} dummy rows in {elapsed:.2f} seconds ({total / elapsed if elapsed else 0:.0f} rows/s)")
+
+if __name__ == "__main__":
+    main()
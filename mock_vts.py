@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import base64
+import hashlib
+import argparse
+import asyncio
+from datetime import datetime
+
+# === Helper Functions ===
+def get_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def log(level, message):
+    print(f"[{level}] {get_timestamp()} - {message}", flush=True)
+
+# === Argument Parsing ===
+parser = argparse.ArgumentParser(description="Mock Thales VTS tokenize/detokenize server for local testing and benchmarks")
+parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+parser.add_argument("--port", type=int, default=8090, help="Port to listen on")
+parser.add_argument("--user", default="", help="Require this basic auth user name (empty: no auth)")
+parser.add_argument("--password", default="", help="Basic auth password")
+parser.add_argument("--latency", type=float, default=5.0, help="Base latency per request in ms")
+parser.add_argument("--jitter", type=float, default=0.0, help="Extra uniform random latency per request in ms")
+parser.add_argument("--per-item", type=float, default=0.0, help="Extra latency per array item in microseconds")
+parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+parser.add_argument("--item-error-rate", type=float, default=0.0, help="Fraction of items answered with an error status instead of a token")
+parser.add_argument("--max-concurrent", type=int, default=0, help="Answer HTTP 429 when more requests than this are in flight (0: unlimited)")
+parser.add_argument("--rate-limit", type=float, default=0.0, help="Answer HTTP 429 above this many requests per second (0: unlimited)")
+parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429 responses")
+parser.add_argument("--seed", type=int, default=None, help="Random seed for latency and error injection")
+parser.add_argument("--key", default="mock-vts", help="Secret mixed into the token derivation")
+
+# === Deterministic Reversible Tokens ===
+# Digits map to digits, letters to letters of the same case, everything else is kept, so tokens have
+# the same length and character classes as the input (like a format-preserving VTS template). The
+# shift per position comes from sha256(key, tokengroup, tokentemplate), so the same value always
+# gets the same token and detokenize reverses it exactly.
+ALPHABETS = ("0123456789", "abcdefghijklmnopqrstuvwxyz", "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+def keystream(key, group, template, length):
+    seed = hashlib.sha256(f"{key}|{group}|{template}".encode("utf-8")).digest()
+    out = bytearray()
+    counter = 0
+    while len(out) < length:
+        out.extend(hashlib.sha256(seed + counter.to_bytes(4, "big")).digest())
+        counter += 1
+    return out
+
+def shift(value, key, group, template, direction):
+    stream = keystream(key, group, template, len(value))
+    chars = []
+    for i, ch in enumerate(value):
+        for alphabet in ALPHABETS:
+            pos = alphabet.find(ch)
+            if pos >= 0:
+                ch = alphabet[(pos + direction * stream[i]) % len(alphabet)]
+                break
+        chars.append(ch)
+    return "".join(chars)
+
+def tokenize(value, key, group, template):
+    return shift(str(value), key, group, template, 1)
+
+def detokenize(token, key, group, template):
+    return shift(str(token), key, group, template, -1)
+
+# === Server State ===
+class MockState:
+    def __init__(self, opts):
+        self.opts = opts
+        self.rng = random.Random(opts.seed)
+        self.in_flight = 0
+        self.window = (int(time.time()), 0)
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.requests = 0
+        self.items = 0
+        self.status_counts = {}
+        self.latencies = []
+        self.max_in_flight = 0
+
+    def throttled(self):
+        opts = self.opts
+        if opts.max_concurrent and self.in_flight > opts.max_concurrent:
+            return True
+        if opts.rate_limit:
+            second, count = self.window
+            now = int(time.time())
+            if now != second:
+                second, count = now, 0
+            self.window = (second, count + 1)
+            return count + 1 > opts.rate_limit
+        return False
+
+    def stats(self):
+        lat = sorted(self.latencies)
+
+        def pct(q):
+            return round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 3) if lat else None
+
+        elapsed = time.time() - self.started
+        return {
+            "requests": self.requests,
+            "items": self.items,
+            "status": {str(k): v for k, v in sorted(self.status_counts.items())},
+            "maxInFlight": self.max_in_flight,
+            "elapsedSeconds": round(elapsed, 3),
+            "requestsPerSecond": round(self.requests / elapsed, 1) if elapsed else None,
+            "latencyMs": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "max": pct(1.0)},
+        }
+
+# === HTTP Handling ===
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+async def read_request(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    request_headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            request_headers[name.strip().lower()] = value.strip()
+    length = int(request_headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return method, path, request_headers, body
+
+def build_response(status, payload, extra_headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}", "Content-Type: application/json", f"Content-Length: {len(body)}"]
+    for name, value in (extra_headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+def authorized(state, request_headers):
+    if not state.opts.user:
+        return True
+    expected = base64.b64encode(f"{state.opts.user}:{state.opts.password}".encode("utf-8")).decode("ascii")
+    return request_headers.get("authorization") == f"Basic {expected}"
+
+async def handle_vts(state, action, body):
+    opts = state.opts
+    items = json.loads(body)
+    if not isinstance(items, list):
+        items = [items]
+    state.items += len(items)
+
+    delay = opts.latency + (state.rng.uniform(0, opts.jitter) if opts.jitter else 0.0) + opts.per_item * len(items) / 1000.0
+    await asyncio.sleep(delay / 1000.0)
+
+    if opts.error_rate and state.rng.random() < opts.error_rate:
+        return 500, {"status": "error", "reason": "injected failure"}, None
+
+    results = []
+    for item in items:
+        group, template = item.get("tokengroup"), item.get("tokentemplate")
+        if opts.item_error_rate and state.rng.random() < opts.item_error_rate:
+            results.append({"status": "error", "reason": "injected item failure"})
+        elif action == "tokenize":
+            value = item.get("data")
+            results.append({"token": None if value is None else tokenize(value, opts.key, group, template), "status": "Succeed"})
+        else:
+            token = item.get("token")
+            results.append({"data": None if token is None else detokenize(token, opts.key, group, template), "status": "Succeed"})
+    return 200, results, None
+
+async def route(state, method, path, request_headers, body):
+    if method == "GET" and path == "/stats":
+        return 200, state.stats(), None
+    if method == "POST" and path == "/reset":
+        state.reset()
+        return 200, {"status": "reset"}, None
+    if method != "POST" or not (path.endswith("/tokenize") or path.endswith("/detokenize")):
+        return 404, {"status": "error", "reason": f"no route for {method} {path}"}, None
+    if not authorized(state, request_headers):
+        return 401, {"status": "error", "reason": "unauthorized"}, None
+    if state.throttled():
+        return 429, {"status": "error", "reason": "throttled"}, {"Retry-After": f"{state.opts.retry_after:g}"}
+    try:
+        return await handle_vts(state, "tokenize" if path.endswith("/tokenize") else "detokenize", body)
+    except (ValueError, AttributeError) as e:
+        return 400, {"status": "error", "reason": f"bad request: {e}"}, None
+
+async def serve_connection(state, reader, writer):
+    try:
+        while True:
+            try:
+                method, path, request_headers, body = await read_request(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            counted = path != "/stats" and path != "/reset"
+            started = time.monotonic()
+            if counted:
+                state.in_flight += 1
+                state.max_in_flight = max(state.max_in_flight, state.in_flight)
+            try:
+                status, payload, extra = await route(state, method, path, request_headers, body)
+            finally:
+                if counted:
+                    state.in_flight -= 1
+            writer.write(build_response(status, payload, extra))
+            await writer.drain()
+            if counted:
+                state.requests += 1
+                state.status_counts[status] = state.status_counts.get(status, 0) + 1
+                state.latencies.append(time.monotonic() - started)
+            if request_headers.get("connection", "").lower() == "close":
+                break
+    finally:
+        writer.close()
+
+# === Main Execution ===
+async def main(opts):
+    state = MockState(opts)
+    server = await asyncio.start_server(lambda r, w: serve_connection(state, r, w), opts.host, opts.port, backlog=4096)
+    log("INFO", f"Mock VTS listening on http://{opts.host}:{opts.port} (pid {os.getpid()}): tokenize at /vts/tokenize, detokenize at /vts/detokenize, stats at /stats")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        log("INFO", "Interrupted by user")